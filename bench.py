@@ -0,0 +1,495 @@
+'''Benchmarks for Alfred's language pipeline; run `python bench.py <benchmark>`'''
+
+from main import Alfred, build_grammar
+from tok import tokenize, CommandInputToken
+from commands import Command, Context
+from treematch import TreeMatcher
+from shellpool import ShellPool
+from completion import Completer
+import dircache
+
+import argparse
+import io
+import json
+import os
+import random
+import re
+import tempfile
+import time
+import timeit
+import tracemalloc
+
+
+def chained_sentence(clauses: int) -> str:
+    # long requests are chains of simple clauses, which is where parsing gets expensive
+    return ' then '.join(['move everything in `a` to `b`'] * clauses)
+
+
+def parse_memory(args):
+    '''Peak memory allocated while parsing chained sentences of increasing length'''
+
+    alfred = Alfred()
+
+    print(f'{"tokens":>8} {"peak KiB":>12}')
+
+    for clauses in args.clauses:
+        sentence = chained_sentence(clauses)
+        tokens = len(sentence.split())
+
+        tracemalloc.start()
+        tree = alfred.grammar.parse(sentence)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        status = '' if tree != None else '  (no parse)'
+        print(f'{tokens:>8} {peak / 1024:>12.1f}{status}')
+
+
+def clause_scaling(args):
+    '''Parse time of chained sentences as one CYK problem vs. split into clauses, in-process and on a pool of workers'''
+
+    grammars = [build_grammar(), build_grammar(split_clauses=True), build_grammar(split_clauses=True, workers=args.workers)]
+
+    print(f'{"clauses":>8} {"tokens":>8} {"whole ms":>10} {"split ms":>10} {"pooled ms":>10}')
+
+    for clauses in args.clauses:
+        sentence = chained_sentence(clauses)
+        timings = []
+
+        for grammar in grammars:
+            grammar.parse(sentence) # warm up (and start the pool's workers)
+
+            runs, total = timeit.Timer(lambda: grammar.parse(sentence)).autorange()
+            timings.append(total / runs * 1e3)
+
+        print(f'{clauses:>8} {len(sentence.split()):>8} {timings[0]:>10.2f} {timings[1]:>10.2f} {timings[2]:>10.2f}')
+
+    grammars[2].close()
+
+
+def sentence_of_length(tokens: int) -> str:
+    # simple clauses (mixing the conjunctions) chained until the next one wouldn't fit
+    clauses = ['move everything in `a` to `b`', 'list the contents of `a`', 'recursively delete `c`', 'copy `a` to `b`']
+    conjunctions = [' then ', ' and ', ', ']
+    sentence = clauses[0]
+
+    for x in range(1, tokens):
+        longer = sentence + conjunctions[x % len(conjunctions)] + clauses[x % len(clauses)]
+
+        if len(tokenize(longer)) > tokens:
+            break
+
+        sentence = longer
+
+    return sentence
+
+
+def parse_scaling(args):
+    '''Parse time of whole sentences (no splitting into clauses) of increasing length, and whether
+    they parsed at all, for each parser backend; also the time to give up on each sentence when
+    its last word is missing, so it can't be parsed'''
+
+    backends = ['python']
+
+    try:
+        import numpy
+        backends.append('numpy')
+    except ImportError:
+        pass
+
+    grammars = [build_grammar(backend=backend) for backend in backends]
+
+    print(f'{"tokens":>8}' + ''.join(f' {backend + " ms":>12} {"parsed":>7} {"no parse ms":>12}' for backend in backends))
+
+    for tokens in args.tokens:
+        sentence = sentence_of_length(tokens)
+        cut_short = sentence.rsplit(' ', 1)[0]
+        row = f'{len(tokenize(sentence)):>8}'
+
+        for grammar in grammars:
+            runs, total = timeit.Timer(lambda: grammar.parse(sentence)).autorange()
+            parsed = grammar.parse(sentence) != None
+
+            failed_runs, failed_total = timeit.Timer(lambda: grammar.parse(cut_short)).autorange()
+
+            row += f' {total / runs * 1e3:>12.2f} {"yes" if parsed else "NO":>7} {failed_total / failed_runs * 1e3:>12.2f}'
+
+        print(row)
+
+
+def tree_shape(tree: 'ParseTreeNode') -> tuple:
+    if tree == None:
+        return None
+    elif tree.left == None:
+        return tree.cat, repr(tree.data)
+    else:
+        return tree.cat, tree_shape(tree.left), tree_shape(tree.right)
+
+
+def pruning(args):
+    '''Latency & accuracy (trees identical to exhaustive CYK's) of pruned and best-first parsing'''
+
+    corpus = VALID_SENTENCES + INVALID_SENTENCES + [sentence_of_length(tokens) for tokens in args.tokens if tokens <= 200]
+    configs = [
+        ('exhaustive', {}),
+        ('beam 1', {'beam': 1}),
+        ('beam 2', {'beam': 2}),
+        ('threshold 1e-2', {'threshold': 1e-2}),
+        ('threshold 1e-4', {'threshold': 1e-4}),
+        ('best-first', {'backend': 'agenda'}),
+    ]
+
+    expected = None
+    print(f'{"mode":>16} {"usec/sentence":>14} {"same tree":>10} {"parsed":>7}')
+
+    for name, options in configs:
+        grammar = build_grammar(**options)
+        trees = [tree_shape(grammar.parse(sentence)) for sentence in corpus]
+        expected = expected or trees
+
+        runs, total = timeit.Timer(lambda: [grammar.parse(sentence) for sentence in corpus]).autorange()
+        same = sum(tree == expect for tree, expect in zip(trees, expected))
+        parsed = sum(tree != None for tree in trees)
+
+        print(f'{name:>16} {total / runs / len(corpus) * 1e6:>14.1f} {same:>6}/{len(corpus):<3} {parsed:>7}')
+
+
+def completion(args):
+    '''Time to complete the word being typed after each keystroke of a long request, reusing the
+    prefix chart from the keystroke before vs. building it from scratch every time'''
+
+    grammar = build_grammar()
+    sentence = sentence_of_length(max(args.tokens))
+    lines = [sentence[:end] for end in range(len(sentence) + 1)]
+
+    def typing(fresh: bool) -> [float]:
+        completer = Completer(grammar)
+        timings = []
+
+        for line in lines:
+            text = re.split('[ `,]', line)[-1]
+            start = timeit.default_timer()
+
+            if fresh:
+                completer.chart = grammar.prefix_chart()
+                completer.before = ''
+
+            completer.suggestions(line, text)
+            timings.append(timeit.default_timer() - start)
+
+        return timings
+
+    reused, fresh = typing(False), typing(True)
+    print(f'{"line chars":>12} {"reused usec":>12} {"fresh usec":>12}')
+
+    # averaged over stretches of the line, so it shows how completion keeps up as the line grows
+    step = max(1, len(lines) // 8)
+
+    for start in range(0, len(lines), step):
+        end = min(start + step, len(lines))
+        print(f'{f"{start}-{end - 1}":>12} {sum(reused[start:end]) / (end - start) * 1e6:>12.1f} {sum(fresh[start:end]) / (end - start) * 1e6:>12.1f}')
+
+
+def earley(args):
+    '''Earley vs. CYK (the python backend), on short requests and on long ones'''
+
+    cyk, earley = build_grammar(), build_grammar(backend='earley')
+    workloads = [('requests', VALID_SENTENCES + INVALID_SENTENCES)] + [(f'{tokens} tokens', [sentence_of_length(tokens)]) for tokens in args.tokens]
+
+    print(f'{"sentences":>14} {"cyk usec":>12} {"earley usec":>12} {"same trees":>11}')
+
+    for name, sentences in workloads:
+        timings = []
+
+        for grammar in (cyk, earley):
+            runs, total = timeit.Timer(lambda: [grammar.parse(sentence) for sentence in sentences]).autorange()
+            timings.append(total / runs / len(sentences) * 1e6)
+
+        same = all(tree_shape(cyk.parse(sentence)) == tree_shape(earley.parse(sentence)) for sentence in sentences)
+        print(f'{name:>14} {timings[0]:>12.1f} {timings[1]:>12.1f} {"yes" if same else "NO":>11}')
+
+
+def tokenize_speed(args):
+    '''Tokenizer throughput on requests with long embedded commands'''
+
+    print(f'{"command chars":>14} {"usec/call":>12} {"MB/s":>10}')
+
+    for size in args.sizes:
+        command = ' '.join(['echo', 'a,b.c?'] * (size // 11 + 1))[:size]
+        sentence = f'do `{command}`, then list the contents of `{command}`.'
+
+        runs, total = timeit.Timer(lambda: tokenize(sentence)).autorange()
+        per_call = total / runs
+
+        print(f'{size:>14} {per_call * 1e6:>12.1f} {len(sentence) / per_call / 1e6:>10.1f}')
+
+
+def raw_commands(args):
+    '''Latency of "do `...`" requests with a fresh shell per command vs. the pool of long-lived shells'''
+
+    alfred = Alfred()
+    sentences = ['do `true`', 'do `echo hello`', 'do `ls /`']
+
+    print(f'{"command":>16} {"fork ms":>10} {"pooled ms":>10}')
+
+    for sentence in sentences:
+        timings = []
+
+        for pool in (None, ShellPool()):
+            Command.shell_pool = pool
+            alfred.respond(sentence) # warm up (and start the pool's shell)
+
+            runs, total = timeit.Timer(lambda: alfred.respond(sentence)).autorange()
+            timings.append(total / runs * 1e3)
+
+            if pool != None:
+                pool.close()
+
+        print(f'{sentence[3:]:>16} {timings[0]:>10.2f} {timings[1]:>10.2f}')
+
+
+def batch(args):
+    '''Time per sentence of a script of long requests that run shell commands, answered one at a time
+    vs. in batch mode, parsing ahead on a thread and on a pool of workers'''
+
+    clause = 'do `true` and list the contents of `.`'
+    print(f'{"clauses":>8} {"one at a time ms":>17} {"batch ms":>10} {"pooled ms":>10}')
+
+    for clauses in args.clauses:
+        sentences = [' then '.join([clause] * clauses)] * args.samples
+        timings = []
+
+        for workers in (None, None, args.workers):
+            alfred = Alfred(workers)
+            alfred.grammar.cache = None # every sentence would be a hit otherwise
+            out = io.StringIO()
+            alfred.run_batch(sentences[:1], out) # warm up (and start the pool's workers & shells)
+            start = timeit.default_timer()
+
+            if not timings:
+                for sentence in sentences:
+                    alfred.stream_response(sentence, out)
+            else:
+                alfred.run_batch(sentences, out)
+
+            timings.append((timeit.default_timer() - start) / len(sentences) * 1e3)
+            alfred.grammar.close()
+
+        print(f'{clauses:>8} {timings[0]:>17.2f} {timings[1]:>10.2f} {timings[2]:>10.2f}')
+
+
+def listing(args):
+    '''Time to list directories of different sizes, reading them every time vs. from the listing cache'''
+
+    print(f'{"entries":>8} {"read usec":>12} {"cached usec":>12}')
+
+    for size in args.entries:
+        with tempfile.TemporaryDirectory() as path:
+            for x in range(size):
+                open(os.path.join(path, f'file{x}'), 'w').close()
+
+            time.sleep(dircache.RACY_NS / 1e9) # until the directory's old enough to cache
+
+            cmd = Command.from_parse_tree(build_grammar().parse(f'list the contents of `{path}`'), Context())
+            timings = []
+
+            for listings in (None, dircache.ListingCache()):
+                Command.listings = listings
+                cmd.run() # warm up (and fill the cache)
+
+                runs, total = timeit.Timer(cmd.run).autorange()
+                timings.append(total / runs * 1e6)
+
+        print(f'{size:>8} {timings[0]:>12.1f} {timings[1]:>12.1f}')
+
+
+# sentences Alfred understands, and ones he can parse but that aren't commands
+VALID_SENTENCES = [
+    'list the contents of `a`',
+    'show me the contents of `a`',
+    'what is inside `a`',
+    'move everything in `a` to `b`',
+    'put `a` in `b`',
+    'copy `a` to `b`',
+    'recursively delete `a`',
+    'remove everything in `a`',
+    'do `echo hi`',
+    'list the contents of `a` then copy `a` to `b` and delete `c`',
+    'move `a` to `b` and list the contents of there',
+]
+
+# paths filled into command inputs of sampled sentences
+SAMPLE_PATHS = ['a', 'b', 'src/main.py', '/tmp', '~/Documents']
+
+INVALID_SENTENCES = [
+    'list `a`',
+    'tell me everything in `a`',
+    'copy everything in `a` to `b`',
+    'move the contents of `a` to `b`',
+    'rename everything in `a` to `b`',
+    'delete the contents of `a`',
+    'recursively list `a`',
+    'do the contents of `a`',
+    'what is to `a`',
+    'list the contents of `a` then run everything',
+]
+
+
+def interpret(args):
+    '''Turning parse trees into commands, the first time through the command patterns (while the
+    automaton is still being built) and once it's warmed up'''
+
+    alfred = Alfred()
+    print(f'{"sentences":>10} {"first usec":>12} {"warm usec":>12}')
+
+    for name, sentences in (('valid', VALID_SENTENCES), ('invalid', INVALID_SENTENCES)):
+        trees = [alfred.grammar.parse(sentence) for sentence in sentences]
+
+        def run():
+            context = Context()
+
+            for tree in trees:
+                Command.from_parse_tree(tree, context)
+
+        Command.matcher = TreeMatcher(Command.matcher.owners)
+        first = timeit.Timer(run).timeit(1)
+
+        runs, total = timeit.Timer(run).autorange()
+
+        print(f'{name:>10} {first / len(trees) * 1e6:>12.1f} {total / runs / len(trees) * 1e6:>12.1f}')
+
+
+def sample_sentence(grammar: 'Grammar', rng: random.Random, clauses: int, clause_length: int) -> str:
+    # clauses drawn from the grammar by its rule probabilities (redrawn if they join clauses themselves,
+    # nest too deep or run longer than clause_length), then joined like a request would be
+    conjunctions = {rule.rhs for rule in grammar.lexicon if rule.lhs == 'Conj'}
+    sentence = ''
+
+    for x in range(clauses):
+        phrase = None
+
+        while phrase == None or len(phrase) > clause_length or any(word in conjunctions for word in phrase):
+            phrase = grammar.sample(rng)
+
+        words = [f'`{rng.choice(SAMPLE_PATHS)}`' if type(word) == CommandInputToken else word for word in phrase]
+
+        if x > 0:
+            # a comma straight after a word would be read as part of it
+            sentence += rng.choice([' then ', ' and ', ', ' if sentence.endswith('`') else ' , '])
+
+        sentence += ' '.join(words)
+
+    return sentence
+
+
+def time_stages(grammar: 'Grammar', sentences: [str]) -> dict:
+    # each stage is timed on its own over the whole workload, fed what the stage before produced
+    tokens = [tokenize(sentence.lower()) for sentence in sentences]
+    trees = [grammar.parse_tokens(toks) for toks in tokens]
+    cmds = [Command.from_parse_tree(tree, Context()) for tree in trees if tree != None]
+    cmds = [cmd for cmd in cmds if cmd != None]
+
+    stages = {
+        'tokenize': lambda: [tokenize(sentence.lower()) for sentence in sentences],
+        'parse': lambda: [grammar.parse_tokens(toks) for toks in tokens],
+        'interpret': lambda: [Command.from_parse_tree(tree, Context()) for tree in trees if tree != None],
+        'exec': lambda: [cmd.exec() for cmd in cmds],
+    }
+
+    usec = {}
+
+    for stage, work in stages.items():
+        runs, total = timeit.Timer(work).autorange()
+        usec[stage] = total / runs / len(sentences) * 1e6
+
+    return {
+        'sentences': len(sentences),
+        'tokens': sum(len(toks) for toks in tokens) / len(sentences),
+        'parsed': sum(tree != None for tree in trees),
+        'commands': len(cmds),
+        'usec': usec,
+    }
+
+
+def suite(args):
+    '''Time per sentence of each stage of answering a request (tokenizing, parsing, turning the tree into
+    a command, and running it dry), on real requests, and on ones sampled from the grammar and chains of
+    real ones with more and more clauses; --output saves the results as JSON, and --compare shows how they changed since an
+    earlier run's'''
+
+    grammar = build_grammar(split_clauses=True) # like Alfred's, but without the cache
+
+    workloads = [('requests', VALID_SENTENCES), ('not commands', INVALID_SENTENCES)]
+    requests = [sentence for sentence in VALID_SENTENCES if not any(conj in sentence for conj in (' then ', ' and ', ','))]
+
+    for clauses in args.clauses:
+        # seeded per workload, so it's the same sentences whichever other workloads are run
+        rng = random.Random(f'{args.seed}:{clauses}')
+        workloads.append((f'{clauses} clauses', [sample_sentence(grammar, rng, clauses, args.clause_length) for x in range(args.samples)]))
+        workloads.append((f'{clauses} commands', [' then '.join(rng.choices(requests, k=clauses)) for x in range(args.samples)]))
+
+    Command.dry_run = True
+    results = {name: time_stages(grammar, sentences) for name, sentences in workloads}
+    Command.dry_run = False
+
+    stages = list(results['requests']['usec'])
+    old = None
+
+    if args.compare != None:
+        with open(args.compare) as f:
+            old = json.load(f)['results']
+
+    print(f'{"workload":>14} {"tokens":>7} {"parsed":>7} {"commands":>9}' + ''.join(f' {stage + " usec":>15}' for stage in stages))
+
+    for name, result in results.items():
+        row = f'{name:>14} {result["tokens"]:>7.1f} {result["parsed"]:>7} {result["commands"]:>9}'
+
+        for stage in stages:
+            usec = result['usec'][stage]
+
+            if old != None and name in old:
+                # relative to the earlier run, so slowdowns stand out
+                row += f' {usec:>8.1f} {usec / old[name]["usec"][stage]:>5.2f}x'
+            else:
+                row += f' {usec:>15.1f}'
+
+        print(row)
+
+    if args.output != None:
+        with open(args.output, 'w') as f:
+            json.dump({'seed': args.seed, 'samples': args.samples, 'clause_length': args.clause_length, 'results': results}, f, indent=2)
+
+
+benchmarks = {
+    'parse-memory': parse_memory,
+    'clauses': clause_scaling,
+    'scaling': parse_scaling,
+    'pruning': pruning,
+    'completion': completion,
+    'earley': earley,
+    'tokenize': tokenize_speed,
+    'raw-commands': raw_commands,
+    'interpret': interpret,
+    'suite': suite,
+    'batch': batch,
+    'listing': listing,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('benchmark', choices=benchmarks.keys())
+    parser.add_argument('--clauses', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32], help='clauses per chained sentence')
+    parser.add_argument('--tokens', type=int, nargs='+', default=[10, 25, 50, 100, 200, 300, 400, 500], help='tokens per sentence')
+    parser.add_argument('--workers', type=int, default=4, help='worker processes for parsing clauses')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 10000, 100000], help='characters per embedded command')
+
+    parser.add_argument('--entries', type=int, nargs='+', default=[10, 1000, 100000], help='entries per listed directory')
+    parser.add_argument('--samples', type=int, default=20, help='sentences sampled from the grammar (or in the script, for batch) per number of clauses')
+    parser.add_argument('--clause-length', type=int, default=8, help='most tokens per sampled clause')
+    parser.add_argument('--seed', type=int, default=0, help='seed for sampling sentences')
+    parser.add_argument('--output', help='file to save the results of the suite to, as JSON')
+    parser.add_argument('--compare', help='results of an earlier run of the suite to compare with')
+
+    args = parser.parse_args()
+    benchmarks[args.benchmark](args)
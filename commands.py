@@ -1,11 +1,65 @@
 from grammar import ParseTreeNode, Grammar, SyntaxRule, LexicalRule
-from tok import CommandInputToken, ConjunctorToken
+from tok import Token, CommandInputToken, ConjunctorToken, vocabulary
+from scheduler import run_concurrently, OutputRelay
+from shellpool import ShellPool, run_fresh, interrupt_fresh
+from dircache import ListingCache
+from treematch import TreeMatcher, Node, Word, Subtree, Either, Ref, Using, Setting
+import instrument
 
 from queue import Queue
-from collections import defaultdict
 
+import contextvars
+import errno
+import locale
+import os
+import shutil
 import subprocess
 import random
+import re
+
+
+THERE = vocabulary.intern('there')
+
+# characters the shell would do something with in a path (expand, split it at, etc.)
+SHELL_SPECIAL = re.compile(r'[~*?\[\]{}$`\'"\\|&;<>()!#\s]')
+
+try:
+    # Python only picks up the user's locale for character types, but ls sorts listings by its collation
+    locale.setlocale(locale.LC_COLLATE, '')
+except locale.Error: # a locale that isn't installed, which leaves ls sorting by code point too
+    pass
+
+# the working directory of whoever's asking for commands, if it isn't Alfred's own (e.g. a daemon client)
+working_dir = contextvars.ContextVar('working_dir', default=None)
+
+# the shells of the background job a command is running as part of, if any (see jobs.py)
+job_shells = contextvars.ContextVar('job_shells', default=None)
+
+# nouns that stand for a path
+PATHS = ('there', CommandInputToken.placeholder())
+
+# "`a` to `b` from `c` ...", where the first path is bound as the source and any after it as the destination
+PATH_LIST = Node('NP', Word('Noun'), Node('PP', Word('Preposition'), Either(Word('Noun'), Ref('paths'))))
+
+
+def local(path: str) -> str:
+    # relative paths are relative to the working directory of whoever asked for the command
+    cwd = working_dir.get()
+    return os.path.join(cwd, path) if cwd != None else path
+
+
+def move_path(src: str, dest: str):
+    # mv semantics: into dest if it's a directory, replacing files, and across filesystems if need be
+    if os.path.isdir(dest):
+        dest = os.path.join(dest, os.path.basename(src.rstrip('/')))
+
+    try:
+        os.rename(src, dest)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+
+        shutil.move(src, dest)
 
 
 class Context: # helper class representing a "context", or what Alfred remembers
@@ -14,15 +68,199 @@ class Context: # helper class representing a "context", or what Alfred remembers
         # self.last_cmd = None
 
 
+class ExecResult:
+    '''Outcome of running a command, whether natively or through the shell'''
+
+    # kinds of errors
+    MISSING = 'missing' # a path doesn't exist
+    IS_DIRECTORY = 'is a directory'
+    TIMED_OUT = 'timed out' # and was stopped (see Command.timeout)
+    FAILED = 'failed'   # anything else
+
+    def __init__(self, output: str = '', error: str = None):
+        self.output = output
+        self.error = error
+
+    def from_process(result: subprocess.CompletedProcess) -> 'ExecResult':
+        if result.returncode == 0:
+            return ExecResult(result.stdout)
+        elif result.returncode == -1 and 'timed out after' in result.stderr: # how shellpool reports it stopped the command
+            return ExecResult(result.stdout, ExecResult.TIMED_OUT)
+        elif 'No such file or directory' in result.stderr: # yes, this could technically be broken, but it'll do for now
+            return ExecResult(result.stdout, ExecResult.MISSING)
+        elif 'is a directory' in result.stderr.lower():
+            return ExecResult(result.stdout, ExecResult.IS_DIRECTORY)
+        else:
+            return ExecResult(result.stdout, ExecResult.FAILED)
+
+    def from_exception(e: OSError) -> 'ExecResult':
+        if isinstance(e, FileNotFoundError):
+            return ExecResult(error=ExecResult.MISSING)
+        elif isinstance(e, IsADirectoryError):
+            return ExecResult(error=ExecResult.IS_DIRECTORY)
+        else:
+            return ExecResult(error=ExecResult.FAILED)
+
+
 class Command:
     # base class for all commands
-    def exec(self) -> subprocess.CompletedProcess:
-        return subprocess.run(str(self), shell=True, capture_output=True, text=True)
+
+    # commands that can be run natively (with os & shutil) are, unless this is set
+    use_shell = False
+
+    # shell commands run on these long-lived shells, or each on a fresh one if this is None
+    shell_pool = ShellPool()
+
+    # directory listings that listing a directory again reuses, for as long as it hasn't changed, or
+    # None to always read them afresh
+    listings = ListingCache()
+
+    # shell commands are stopped after running for this many seconds, if it's set (the pool has its own)
+    timeout = None
+
+    # matches parse trees against every type of command's patterns (see the bottom of this file)
+    matcher = None
+
+    # when streaming, output held back (e.g. behind an earlier command in a group) is kept in memory
+    # up to this many characters, then spills over to a temporary file
+    spool_size = 1 << 20
+
+    # commands go through everything but touching the filesystem or a shell, and succeed with no
+    # output, if this is set (e.g. to benchmark everything else)
+    dry_run = False
+
+    # what went wrong the last time the command ran, if anything (see ExecResult)
+    error = None
+
+    def exec(self, on_output: 'function' = None) -> subprocess.CompletedProcess:
+        shells = job_shells.get()
+
+        if shells == None:
+            shells = Command.shell_pool
+
+        if shells != None:
+            return instrument.timed('subprocess', shells.run, str(self), on_output, working_dir.get())
+
+        return instrument.timed('subprocess', run_fresh, str(self), on_output, Command.timeout, working_dir.get())
+
+    def interrupt():
+        '''Kills every shell command running outside of a background job (e.g. after ^C)'''
+
+        if Command.shell_pool != None:
+            Command.shell_pool.interrupt()
+
+        interrupt_fresh()
+
+    def run(self, on_output: 'function' = None) -> ExecResult:
+        '''Runs the command; if on_output is given, its output is passed to it as it's produced
+        instead of being returned'''
+
+        if Command.dry_run:
+            return ExecResult()
+
+        # a job's commands all go through its shells, so cancelling it stops them wherever they've got to;
+        # the same goes for everything once there's a timeout, and for whatever could run long enough to
+        # need stopping (a thread running it natively can't be)
+        if Command.use_shell or job_shells.get() != None or Command.timeout != None or \
+                type(self).run_native == Command.run_native or self.needs_shell() or self.may_run_long():
+            result = ExecResult.from_process(Command.exec(self, on_output))
+            self.error = result.error
+            self.forget_listings()
+            return result
+
+        try:
+            output = instrument.timed('native', self.run_native)
+        except OSError as e: # includes shutil.Error
+            result = ExecResult.from_exception(e)
+            self.error = result.error
+            self.forget_listings() # it may have got partway
+            return result
+
+        self.error = None
+        self.forget_listings()
+
+        if on_output == None:
+            return ExecResult(output)
+
+        if output:
+            on_output(output)
+
+        return ExecResult()
+
+    def needs_shell(self) -> bool:
+        # paths with ~, globs, $VARS, quotes etc. mean whatever the shell makes of them, which running
+        # natively would get wrong
+        paths = self.paths()
+
+        return paths != None and any(SHELL_SPECIAL.search(path) for path in paths[0] | paths[1])
+
+    def may_run_long(self) -> bool:
+        return False
+
+    def forget_listings(self):
+        # the directories the command wrote to may list differently now; it's up to their mtimes
+        # to tell for commands that don't say what they write
+        paths = self.paths()
+
+        if Command.listings != None and paths != None:
+            for path in paths[1]:
+                Command.listings.invalidate(local(path))
+
+    def stream(self, out: 'text file'):
+        '''Writes the command's response (and a newline) to out, passing any output along as it's produced'''
+
+        out.write(self.exec() + '\n')
+        out.flush()
+
+    def stream_under(self, out: 'text file', heading: 'function', response: 'function'):
+        # streams output under heading() as soon as there is any; if there's none, response(result)
+        # is written instead, just like exec would return it
+        streamed = False
+
+        def on_output(text: str):
+            nonlocal streamed
+
+            if not streamed:
+                out.write(heading() + '\n')
+                streamed = True
+
+            out.write(text)
+            out.flush()
+
+        result = self.run(on_output)
+
+        if not streamed:
+            out.write(response(result) + '\n')
+        elif result.error != None:
+            out.write(self.general_error_message() + '\n') # the output's already out, so just say it failed
+        else:
+            out.write('\n')
+
+        out.flush()
+
+    def run_native(self) -> str:
+        '''Does what the command's shell equivalent would, returning its output & raising OSError if it fails'''
+        return NotImplemented
 
     def is_valid(self) -> bool:
         return NotImplemented
 
+    def failed(self) -> bool:
+        '''Whether the command failed the last time it ran'''
+        return self.error != None
+
+    def paths(self) -> (set, set):
+        '''The paths the command reads & writes (each including everything under it), or None if
+        there's no telling what it touches'''
+        return None
+
     def general_error_message(self) -> str:
+        if self.error == ExecResult.TIMED_OUT:
+            return random.choice([
+                "That was taking too long, so I stopped it",
+                "I gave up on that after it ran for too long",
+            ])
+
         responses = [
             "Something [Verb], but I'm not sure what happened",
             'Unfortunately that command failed for an unknown reason',
@@ -33,14 +271,16 @@ class Command:
 
         return random.choice(responses).replace('[Verb]', verb)
 
-    def from_parse_tree(tree: ParseTreeNode, context: Context, include_group=True) -> 'Command':
-        cmd_types = [ListCommand, MoveCommand, CopyCommand, RemoveCommand, RawCommand]
+    def bind(self, slot: str, value: Token, context: Context):
+        '''Fills in a slot the command's patterns bound a word to'''
+        setattr(self, slot, context.last_path if value.sym == THERE else value)
 
-        if include_group:
-            cmd_types.append(CommandGroup)
+    def from_parse_tree(tree: ParseTreeNode, context: Context) -> 'Command':
+        for cmd_type, bindings in Command.matcher.match(tree):
+            if instrument.active != None:
+                instrument.active.count(f'{cmd_type.__name__} tried')
 
-        for cmd_type in cmd_types:
-            cmd = cmd_type(tree, context)
+            cmd = cmd_type(bindings, context)
 
             if cmd.is_valid():
                 return cmd
@@ -48,9 +288,40 @@ class Command:
         return None
 
 class ListCommand(Command):
-    def __init__(self, tree: ParseTreeNode, context: Context):
-        self.dir = None # default before reading parse
-        self._read_parse_tree(tree, defaultdict(set), context)
+    patterns = {
+        'command': Either(
+            Node('S',
+                Either(
+                    Using({'Verb': ('list', 'display', 'find')}, Word('Verb')),
+                    Using({'Verb': ('show', 'tell'), 'Pronoun': ('me',)}, Node('VP', Word('Verb'), Word('Pronoun'))),
+                ),
+                Using({'Noun': ('contents', 'everything', *PATHS), 'Article': ('the',), 'Preposition': ('of', 'in', 'inside')}, Ref('listing'))),
+            Node('S',
+                Using({'Pronoun': ('what',)}, Word('Pronoun')),
+                Using({'Verb': ('is',), 'Preposition': ('in', 'inside'), 'Noun': PATHS}, Ref('is in'))),
+        ),
+        # "the contents of `dir`"
+        'listing': Either(
+            Node('NP', Ref('listing'), Setting({'Noun': PATHS}, Ref('in'))),
+            Node('NP', Word('Article'), Word('Noun')),
+        ),
+        'in': Node('PP', Word('Preposition'), Either(Word('Noun'), Ref('listing'))),
+        # "(what) is in `dir`"
+        'is in': Node('VP', Either(Word('Verb'), Ref('is in')), Ref('in')),
+    }
+
+    binds = {('Noun', path): 'dir' for path in PATHS}
+
+    effects = {
+        ('Noun', 'contents'): {'Noun': ('contents',), 'Preposition': ('of',)},
+        ('Noun', 'everything'): {'Noun': ('everything',), 'Preposition': ('in', 'inside'), 'Article': ()},
+    }
+
+    def __init__(self, bindings: [(str, Token)], context: Context):
+        self.dir = None # default before binding
+
+        for slot, value in bindings:
+            self.bind(slot, value, context)
 
         if self.is_valid():
             context.last_path = self.dir
@@ -61,14 +332,54 @@ class ListCommand(Command):
     def is_valid(self) -> bool:
         return self.dir != None
 
+    def paths(self) -> (set, set):
+        return {self.dir.content}, set()
+
+    def run_native(self) -> str:
+        path = local(self.dir.content or '.') # `ls ` with nothing after it lists the current directory
+
+        if not os.path.isdir(path):
+            os.stat(path) # raises if it doesn't exist, otherwise ls just echoes a file's name
+            return self.dir.content + '\n'
+
+        if Command.listings != None:
+            return Command.listings.list(path, ListCommand.read_listing)
+
+        return ListCommand.read_listing(path)
+
+    def read_listing(path: str) -> str:
+        with os.scandir(path) as entries:
+            # in the order ls sorts them, which follows the user's locale
+            names = sorted((entry.name for entry in entries if not entry.name.startswith('.')), key=locale.strxfrm)
+
+        return ''.join(name + '\n' for name in names)
+
     def exec(self) -> str:
-        result = Command.exec(self)
+        return self.response(self.run())
 
-        # first, check for error
-        if result.returncode != 0: # assumed to be error
-            stderr = result.stderr
+    def stream(self, out: 'text file'):
+        self.stream_under(out, self.heading, self.response)
+
+    def heading(self) -> str:
+        responses = [
+            "`dir` contains:",
+            "Inside `dir` is:",
+            "I [Verb] the following [Prep] `dir`:",
+            "Here's what I [Verb]:"
+        ]
+
+        verbs = ['found', 'saw']
+
+        response = random.choice(responses)
+        verb = random.choice(verbs)
+        prep = random.choice(['in', 'inside'])
 
-            if 'No such file or directory' in stderr: # yes, this could technically be broken, but it'll do for now
+        return response.replace('[Verb]', verb).replace('dir', self.dir.content).replace('[Prep]', prep)
+
+    def response(self, result: ExecResult) -> str:
+        # first, check for error
+        if result.error != None:
+            if result.error == ExecResult.MISSING:
                 responses = [
                     "I couldn't [Verb] `dir`",
                     "`dir` doesn't seem to exist"
@@ -84,7 +395,7 @@ class ListCommand(Command):
                 # generic error
                 response = self.general_error_message()
         else:
-            stdout = result.stdout
+            stdout = result.output
 
             if stdout == '': # assume directory is empty
                 responses = [
@@ -95,115 +406,41 @@ class ListCommand(Command):
 
                 response = random.choice(responses).replace('dir', self.dir.content) + '\n' + stdout
             else:
-                responses = [
-                    "`dir` contains:",
-                    "Inside `dir` is:",
-                    "I [Verb] the following [Prep] `dir`:",
-                    "Here's what I [Verb]:"
-                ]
-
-                verbs = ['found', 'saw']
-
-                response = random.choice(responses)
-                verb = random.choice(verbs)
-                prep = random.choice(['in', 'inside'])
-
-                response = response.replace('[Verb]', verb).replace('dir', self.dir.content).replace('[Prep]', prep) + '\n' + stdout
+                response = self.heading() + '\n' + stdout
 
         return response
 
-    def _read_parse_tree(self, node: ParseTreeNode, lexicon: {str : set}, context: Context) -> bool:
-        # if root is syntactic, parse children recursively with remaining lexicon
-        if node.data == None:
-            if node.cat == 'S':
-                if node.left != None:
-                    if node.left.cat == 'VP' or node.left.cat == 'Verb':
-                        if node.left.cat == 'VP':
-                            lexicon = defaultdict(set, {
-                                'Verb' : {'show', 'tell'},
-                                'Pronoun' : {'me'},
-                            })
-                        else:
-                            lexicon = defaultdict(set, {
-                                'Verb' : {'list', 'display', 'find'}
-                            })
-
-                        if not self._read_parse_tree(node.left, lexicon, context):
-                            return False # if parse fails, return failure
-
-                        if node.right != None:
-                            if node.right.cat == 'NP':
-                                lexicon = defaultdict(set, {
-                                    'Noun' : {'contents', 'everything', 'there', CommandInputToken.placeholder()},
-                                    'Article' : {'the'},
-                                    'Preposition' : {'of', 'in', 'inside'},
-                                })
-
-                                return self._read_parse_tree(node.right, lexicon, context) # result of right parse is the ultimate result
-                    elif node.left.cat == 'Pronoun':
-                        lexicon = defaultdict(set, {
-                            'Pronoun' : {'what'}
-                        })
-
-                        if not self._read_parse_tree(node.left, lexicon, context):
-                            return False # if parse fails, return failure
-
-                        if node.right != None:
-                            if node.right.cat == 'VP':
-                                lexicon = defaultdict(set, {
-                                    'Verb' : {'is'},
-                                    'Preposition' : {'in', 'inside'},
-                                    'Noun' : {'there', CommandInputToken.placeholder()},
-                                })
-
-                                return self._read_parse_tree(node.right, lexicon, context) # result of right parse is the ultimate result
-            elif node.cat == 'VP':
-                # assume lexicon was appropriately configured previously
-                if node.left != None and node.right != None:
-                    return self._read_parse_tree(node.left, lexicon, context) and self._read_parse_tree(node.right, lexicon, context)
-            elif node.cat == 'NP':
-                if node.left != None and node.right != None:
-                    if node.left.cat == 'NP' and node.right.cat == 'PP':
-                        if not self._read_parse_tree(node.left, lexicon, context):
-                            return False
-
-                        lexicon['Noun'] = {'there', CommandInputToken.placeholder()}
-
-                        return self._read_parse_tree(node.right, lexicon, context)
-                    elif node.left.cat == 'Article' and node.right.cat == 'Noun':
-                        return self._read_parse_tree(node.left, lexicon, context) and self._read_parse_tree(node.right, lexicon, context)
-            elif node.cat == 'PP':
-                if node.left != None and node.right != None:
-                    return self._read_parse_tree(node.left, lexicon, context) and self._read_parse_tree(node.right, lexicon, context)
-
-            return False # indicate failure if success isn't found above
-        # if root is lexical, make sure word matches remaining lexicon
-        else:
-            if node.cat == 'Noun':
-                if type(node.data) == CommandInputToken:
-                    self.dir = node.data
-                elif node.data == 'there':
-                    self.dir = context.last_path
-                elif node.data == 'contents':
-                    lexicon['Noun'] = {'contents'}
-                    lexicon['Preposition'] = {'of'}
-                elif node.data == 'everything':
-                    lexicon['Noun'] = {'everything'}
-                    lexicon['Preposition'] = {'in', 'inside'}
-                    lexicon['Article'] = set()
-
-            return node.data in lexicon[node.cat]
-
-
 class MoveCommand(Command):
-    def __init__(self, tree: ParseTreeNode, context: Context):
-        # defaults before reading parse
+    patterns = {
+        'command': Using({
+            'Verb': ('move', 'rename', 'put', 'place'),
+            'Noun': ('everything', *PATHS),
+            'Preposition': ('to', 'in', 'inside', 'from'),
+        }, Node('S', Word('Verb'), Ref('paths'))),
+        'paths': PATH_LIST,
+    }
+
+    binds = {
+        **{('Noun', path): 'path' for path in PATHS},
+        ('Noun', 'everything'): 'is_glob',
+        **{('Verb', verb): 'request' for verb in ('move', 'rename', 'put', 'place')},
+    }
+
+    effects = {
+        ('Verb', 'rename'): {'Preposition': ('to',), 'Noun': PATHS},
+        ('Verb', 'put'): {'Preposition': ('in', 'inside'), 'Noun': PATHS},
+        ('Verb', 'place'): {'Preposition': ('in', 'inside'), 'Noun': PATHS},
+    }
+
+    def __init__(self, bindings: [(str, Token)], context: Context):
+        # defaults before binding
         self.src_path = None
         self.dest_path = None
         self.is_glob = False
         self.request = None
 
-        self._read_parse_tree(tree, defaultdict(set), context)
+        for slot, value in bindings:
+            self.bind(slot, value, context)
 
         if self.is_valid():
             context.last_path = self.dest_path
@@ -216,14 +453,46 @@ class MoveCommand(Command):
     def is_valid(self) -> bool:
         return self.src_path != None and self.dest_path != None
 
+    def paths(self) -> (set, set):
+        return set(), {self.src_path.content, self.dest_path.content}
+
+    def bind(self, slot: str, value: Token, context: Context):
+        if slot == 'path':
+            Command.bind(self, 'src_path' if self.src_path == None else 'dest_path', value, context)
+        elif slot == 'is_glob':
+            self.is_glob = True
+        elif slot == 'request':
+            self.request = value.word
+
+    def run_native(self) -> str:
+        src = local(self.src_path.content)
+        dest = local(self.dest_path.content)
+
+        if self.is_glob:
+            with os.scandir(src) as entries:
+                names = sorted(entry.name for entry in entries if not entry.name.startswith('.'))
+
+            if len(names) == 0:
+                # with nothing to match, the shell passes src/* through literally, which mv can't find
+                raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), os.path.join(src, '*'))
+            elif len(names) > 1 and not os.path.isdir(dest):
+                # mv can only move several things into a directory
+                os.stat(dest)
+                raise NotADirectoryError(errno.ENOTDIR, os.strerror(errno.ENOTDIR), dest)
+
+            for name in names:
+                move_path(os.path.join(src, name), dest)
+        else:
+            move_path(src, dest)
+
+        return ''
+
     def exec(self) -> str:
-        result = Command.exec(self)
+        result = self.run()
 
         # first, check for error
-        if result.returncode != 0: # assumed to be error
-            stderr = result.stderr
-
-            if 'No such file or directory' in stderr: # yes, this could technically be broken, but it'll do for now
+        if result.error != None:
+            if result.error == ExecResult.MISSING:
                 responses = [
                     "Sorry, I couldn't [Verb] `src`",
                     "`src` doesn't seem to exist, so I couldn't [InputVerb] it"
@@ -239,7 +508,7 @@ class MoveCommand(Command):
                 # generic error
                 response = self.general_error_message()
         else:
-            stdout = result.stdout
+            stdout = result.output
 
             if self.is_glob:
                 responses = [
@@ -259,63 +528,27 @@ class MoveCommand(Command):
 
         return response
 
-    def _read_parse_tree(self, node: ParseTreeNode, lexicon: {str : set}, context: Context) -> bool:
-        if node.data == None:
-            if node.cat == 'S':
-                if node.left != None and node.right != None:
-                    # print(node.left.cat, node.right.cat)
-                    if node.left.cat == 'Verb' and node.right.cat == 'NP':
-                        # this is the only possible syntax -- lexicon varies
-                        full_lexicon = defaultdict(set, {
-                            'Verb' : {'move', 'rename', 'put', 'place'},
-                            'Noun' : {'everything', 'there', CommandInputToken.placeholder()},
-                            'Preposition' : {'to', 'in', 'inside', 'from'},
-                        })
-
-                        return self._read_parse_tree(node.left, full_lexicon, context) and self._read_parse_tree(node.right, full_lexicon, context)
-            elif node.cat == 'NP':
-                if node.left != None and node.right != None:
-                    return node.left.cat == 'Noun' and self._read_parse_tree(node.left, lexicon, context) and self._read_parse_tree(node.right, lexicon, context)
-            elif node.cat == 'PP':
-                if node.left != None and node.right != None:
-                    if node.left.cat == 'Preposition' and node.right.cat in {'Noun', 'NP'}:
-                        return self._read_parse_tree(node.left, lexicon, context) and self._read_parse_tree(node.right, lexicon, context)
-
-            return False
-        else:
-            if node.cat == 'Noun':
-                if type(node.data) == CommandInputToken:
-                    if self.src_path == None:
-                        self.src_path = node.data
-                    else:
-                        self.dest_path = node.data
-                elif node.data == 'everything':
-                    self.is_glob = True
-                elif node.data == 'there':
-                    if self.src_path == None:
-                        self.src_path = context.last_path
-                    else:
-                        self.dest_path = context.last_path
-            elif node.cat == 'Verb':
-                if node.data == 'rename':
-                    lexicon['Preposition'] = {'to'}
-                elif node.data in {'put', 'place'}:
-                    lexicon['Preposition'] = {'in', 'inside'}
-
-                if node.data != 'move' and 'everything' in lexicon['Noun']:
-                    lexicon['Noun'].remove('everything')
-
-                self.request = node.data.word
-
-            return node.data in lexicon[node.cat]
-
 class CopyCommand(Command):
-    def __init__(self, tree: ParseTreeNode, context: Context):
-        # defaults before reading parse
+    patterns = {
+        'command': Using({
+            'Verb': ('copy', 'duplicate'),
+            'Noun': PATHS,
+            'Preposition': ('to',),
+        }, Node('S', Word('Verb'), Ref('paths'))),
+        'paths': PATH_LIST,
+    }
+
+    binds = {('Noun', path): 'path' for path in PATHS}
+
+    effects = {}
+
+    def __init__(self, bindings: [(str, Token)], context: Context):
+        # defaults before binding
         self.src_path = None
         self.dest_path = None
 
-        self._read_parse_tree(tree, defaultdict(set), context)
+        for slot, value in bindings:
+            self.bind(slot, value, context)
 
         if self.is_valid():
             context.last_path = self.dest_path
@@ -326,14 +559,22 @@ class CopyCommand(Command):
     def is_valid(self) -> bool:
         return self.src_path != None and self.dest_path != None
 
+    def paths(self) -> (set, set):
+        return {self.src_path.content}, {self.dest_path.content}
+
+    def bind(self, slot: str, value: Token, context: Context):
+        Command.bind(self, 'src_path' if self.src_path == None else 'dest_path', value, context)
+
+    def run_native(self) -> str:
+        shutil.copy(local(self.src_path.content), local(self.dest_path.content))
+        return ''
+
     def exec(self) -> str:
-        result = Command.exec(self)
+        result = self.run()
 
         # first, check for error
-        if result.returncode != 0: # assumed to be error
-            stderr = result.stderr
-
-            if 'No such file or directory' in stderr: # yes, this could technically be broken, but it'll do for now
+        if result.error != None:
+            if result.error == ExecResult.MISSING:
                 responses = [
                     "Sorry, I couldn't [Verb] `src`",
                     "`src` doesn't seem to exist, so I couldn't [InputVerb] it"
@@ -351,7 +592,7 @@ class CopyCommand(Command):
                 # generic error
                 response = self.general_error_message()
         else:
-            stdout = result.stdout
+            stdout = result.output
 
             responses = [
                 "`src` has been [VerbPast] to `dest`",
@@ -365,50 +606,38 @@ class CopyCommand(Command):
 
         return response
 
-    def _read_parse_tree(self, node: ParseTreeNode, lexicon: {str : set}, context: Context) -> bool:
-        if node.data == None:
-            if node.cat == 'S':
-                if node.left != None and node.right != None:
-                    if node.left.cat == 'Verb' and node.right.cat == 'NP':
-                        # this is the only possible syntax -- lexicon varies
-                        full_lexicon = defaultdict(set, {
-                            'Verb' : {'copy', 'duplicate'},
-                            'Noun' : {'there', CommandInputToken.placeholder()},
-                            'Preposition' : {'to'},
-                        })
-
-                        return self._read_parse_tree(node.left, full_lexicon, context) and self._read_parse_tree(node.right, full_lexicon, context)
-            elif node.cat == 'NP':
-                if node.left != None and node.right != None:
-                    return node.left.cat == 'Noun' and self._read_parse_tree(node.left, lexicon, context) and self._read_parse_tree(node.right, lexicon, context)
-            elif node.cat == 'PP':
-                if node.left != None and node.right != None:
-                    if node.left.cat == 'Preposition' and node.right.cat in {'Noun', 'NP'}:
-                        return self._read_parse_tree(node.left, lexicon, context) and self._read_parse_tree(node.right, lexicon, context)
-
-            return False
-        else:
-            if node.cat == 'Noun':
-                if type(node.data) == CommandInputToken:
-                    if self.src_path == None:
-                        self.src_path = node.data
-                    else:
-                        self.dest_path = node.data
-                elif node.data == 'there':
-                    if self.src_path == None:
-                        self.src_path = context.last_path
-                    else:
-                        self.dest_path = context.last_path
-
-            return node.data in lexicon[node.cat]
-
 class RemoveCommand(Command):
-    def __init__(self, tree: ParseTreeNode, context: Context):
-        # defaults before reading parse
+    patterns = {
+        'command': Node('S',
+            Either(
+                Using({'Verb': ('delete', 'remove')}, Word('Verb')),
+                Using({'Verb': ('delete', 'remove'), 'Adverb': ('recursively',)}, Node('VP', Word('Adverb'), Word('Verb'))),
+            ),
+            Either(
+                Using({'Noun': PATHS}, Word('Noun')),
+                Using({'Preposition': ('in', 'inside')}, Ref('everything in')),
+            )),
+        # "everything in `path`"
+        'everything in': Node('NP',
+            Setting({'Noun': ('everything',)}, Word('Noun')),
+            Setting({'Noun': PATHS}, Node('PP', Word('Preposition'), Word('Noun')))),
+    }
+
+    binds = {
+        **{('Noun', path): 'path' for path in PATHS},
+        ('Noun', 'everything'): 'is_recursive',
+        ('Adverb', 'recursively'): 'is_recursive',
+    }
+
+    effects = {}
+
+    def __init__(self, bindings: [(str, Token)], context: Context):
+        # defaults before binding
         self.path = None
         self.is_recursive = False
 
-        self._read_parse_tree(tree, defaultdict(set), context)
+        for slot, value in bindings:
+            self.bind(slot, value, context)
 
         if self.is_valid():
             context.last_path = self.path
@@ -421,14 +650,36 @@ class RemoveCommand(Command):
     def is_valid(self) -> bool:
         return self.path != None
 
+    def paths(self) -> (set, set):
+        return set(), {self.path.content}
+
+    def bind(self, slot: str, value: Token, context: Context):
+        if slot == 'is_recursive':
+            self.is_recursive = True
+        else:
+            Command.bind(self, slot, value, context)
+
+    def may_run_long(self) -> bool:
+        # there's no telling how much is under a directory
+        return self.is_recursive
+
+    def run_native(self) -> str:
+        # only ever non-recursive removes, since recursive ones go through the shell (see may_run_long)
+        path = local(self.path.content)
+
+        if os.path.isdir(path) and not os.path.islink(path):
+            # unlink would say so on Linux, but raises PermissionError on macOS
+            raise IsADirectoryError(errno.EISDIR, os.strerror(errno.EISDIR), path)
+
+        os.unlink(path)
+        return ''
+
     def exec(self) -> str:
-        result = Command.exec(self)
+        result = self.run()
 
         # first, check for error
-        if result.returncode != 0: # assumed to be error
-            stderr = result.stderr
-
-            if 'No such file or directory' in stderr: # yes, this could technically be broken, but it'll do for now
+        if result.error != None:
+            if result.error == ExecResult.MISSING:
                 responses = [
                     "Sorry, I couldn't [Verb] `path`",
                     "`path` doesn't seem to exist, so I couldn't [InputVerb] it"
@@ -442,7 +693,7 @@ class RemoveCommand(Command):
                 input_verb = random.choice(input_verbs)
 
                 response = response.replace('[Verb]', word).replace('[InputVerb]', input_verb).replace('path', self.path.content)
-            elif 'is a directory' in stderr:
+            elif result.error == ExecResult.IS_DIRECTORY:
                 response = "Sorry, I couldn't [Verb] `path` because it's a directory; did you mean to [Verb] it recursively?"
 
                 input_verb = random.choice(['delete', 'remove'])
@@ -451,7 +702,7 @@ class RemoveCommand(Command):
                 # generic error
                 response = self.general_error_message()
         else:
-            stdout = result.stdout
+            stdout = result.output
 
             responses = [
                 "I've successfully [VerbPast] [Everything] `path` [Recursive]",
@@ -475,73 +726,23 @@ class RemoveCommand(Command):
 
         return response
 
-    def _read_parse_tree(self, node: ParseTreeNode, lexicon: {str : set}, context: Context) -> bool:
-        if node.data == None:
-            if node.cat == 'S':
-                if node.left != None and node.right != None:
-                    lexicon = defaultdict(set, {
-                        'Verb' : {'delete', 'remove'} # purge, trash, scrap,
-                    })
-
-                    if node.left.cat == 'VP':
-                        lexicon['Adverb'] = {'recursively'}
-                    elif node.left.cat != 'Verb':
-                        return False
-
-                    if not self._read_parse_tree(node.left, lexicon, context):
-                        return False
-
-                    lexicon = defaultdict(set, {
-                        'Noun' : {'there', CommandInputToken.placeholder()},
-                    })
-
-                    if node.right.cat == 'NP':
-                        lexicon['Noun'].add('everything')
-                        lexicon['Preposition'] = {'in', 'inside'}
-                    elif node.right.cat != 'Noun':
-                        return False
-
-                    return self._read_parse_tree(node.right, lexicon, context)
-            elif node.cat == 'NP':
-                if node.left != None and node.right != None:
-                    if node.left.cat == 'Noun' and node.right.cat == 'PP':
-                        lexicon['Noun'] = {'everything'}
-
-                        if not self._read_parse_tree(node.left, lexicon, context):
-                            return False
-
-                        lexicon['Noun'] = {'there', CommandInputToken.placeholder()}
-                        lexicon['Pronoun'] = {'there'}
-
-                        return self._read_parse_tree(node.right, lexicon, context)
-            elif node.cat == 'PP':
-                if node.left != None and node.right != None:
-                    if node.left.cat == 'Preposition' and node.right.cat == 'Noun':
-                        return self._read_parse_tree(node.left, lexicon, context) and self._read_parse_tree(node.right, lexicon, context)
-            elif node.cat == 'VP':
-                if node.left != None and node.right != None:
-                    if node.left.cat == 'Adverb' and node.right.cat == 'Verb':
-                        return self._read_parse_tree(node.left, lexicon, context) and self._read_parse_tree(node.right, lexicon, context)
-
-            return False
-        else:
-            if node.cat == 'Noun':
-                if type(node.data) == CommandInputToken:
-                    self.path = node.data
-                elif node.data == 'everything':
-                    self.is_recursive = True
-                elif node.data == 'there':
-                    self.path = context.last_path
-            elif node.cat == 'Adverb' and node.data == 'recursively':
-                self.is_recursive = True
+class RawCommand(Command):
+    patterns = {
+        'command': Using({
+            'Verb': ('run', 'do', 'execute'),
+            'Noun': (CommandInputToken.placeholder(),),
+        }, Node('S', Word('Verb'), Word('Noun'))),
+    }
 
-            return node.data in lexicon[node.cat]
+    binds = {('Noun', CommandInputToken.placeholder()): 'cmd'}
 
+    effects = {}
 
-class RawCommand(Command):
-    def __init__(self, tree: ParseTreeNode, context: Context):
+    def __init__(self, bindings: [(str, Token)], context: Context):
         self.cmd = None
-        self._read_parse_tree(tree, defaultdict(set), context)
+
+        for slot, value in bindings:
+            self.bind(slot, value, context)
 
     def __str__(self) -> str:
         return self.cmd.content if self.is_valid() else 'invalid command'
@@ -550,48 +751,57 @@ class RawCommand(Command):
         return self.cmd != None
 
     def exec(self) -> str:
-        result = Command.exec(self)
+        return self.response(self.run())
+
+    def stream(self, out: 'text file'):
+        self.stream_under(out, self.heading, self.response)
+
+    def heading(self) -> str:
+        content = random.choice(['what happened', 'what I got back', 'the results'])
+        return f"Done; here's {content}:"
 
+    def response(self, result: ExecResult) -> str:
         # first, check for error
-        if result.returncode != 0: # assumed to be error
+        if result.error != None:
             response = self.general_error_message()
         else:
-            stdout = result.stdout
+            stdout = result.output
 
             if stdout == '':
                 response = 'I did it; nothing happened, but it was successful.'
             else:
-                response = "Done; here's [Content]:" + '\n' + stdout
+                response = self.heading() + '\n' + stdout
 
-            content = random.choice(['what happened', 'what I got back', 'the results'])
+        return response
 
-        return response.replace('[Content]', content)
+class CommandGroup(Command):
+    # commands that can't interfere with each other run at the same time, on up to this many threads
+    max_workers = 4
 
-    def _read_parse_tree(self, node: ParseTreeNode, lexicon: {str : set}, context: Context) -> bool:
-        if node.data == None:
-            if node.left != None and node.right != None:
-                if node.cat == 'S':
-                    if node.left.cat == 'Verb' and node.right.cat == 'Noun':
-                        lexicon = defaultdict(set, {
-                            'Verb' : {'run', 'do', 'execute'},
-                            'Noun' : {CommandInputToken.placeholder()},
-                        })
+    patterns = {
+        'command': Using({'Conj': ('and', 'then', ConjunctorToken())}, Ref('group')),
+        # "<clause> and <clause> then ...", however the clauses are nested
+        'group': Node('S',
+            Either(Ref('group'), Subtree('S', 'clause')),
+            Node('ConjClause', Word('Conj'), Either(Ref('group'), Subtree('S', 'clause')))),
+    }
 
-                        return self._read_parse_tree(node.left, lexicon, context) and self._read_parse_tree(node.right, lexicon, context)
+    binds = {}
 
-            return False
-        else:
-            if node.cat == 'Noun':
-                if type(node.data) == CommandInputToken:
-                    self.cmd = node.data
+    effects = {}
 
-            return node.data in lexicon[node.cat]
+    def __init__(self, bindings: [(str, ParseTreeNode)], context: Context):
+        self.cmds = []
 
+        # clauses are read in order, so "there" in one means the last path of the one before
+        for slot, clause in bindings:
+            cmd = Command.from_parse_tree(clause, context)
 
-class CommandGroup(Command):
-    def __init__(self, tree: ParseTreeNode, context: Context):
-        self.cmds = []
-        self._read_parse_tree(tree, defaultdict(set), context)
+            if cmd == None:
+                self.cmds = []
+                break
+
+            self.cmds.append(cmd)
 
     def __str__(self) -> str:
         return ' && '.join([str(cmd) for cmd in self.cmds])
@@ -599,31 +809,33 @@ class CommandGroup(Command):
     def is_valid(self) -> bool:
         return len(self.cmds) > 0
 
+    def failed(self) -> bool:
+        return any(cmd.failed() for cmd in self.cmds)
+
     def exec(self) -> str:
-        return '\n'.join([cmd.exec() for cmd in self.cmds])
-
-    def _read_parse_tree(self, node: ParseTreeNode, lexicon: {str : set}, context: Context) -> bool:
-        if node.data == None:
-            if node.left != None and node.right != None:
-                if node.cat == 'S':
-                    if node.left.cat == 'S' and node.right.cat == 'ConjClause':
-                        lexicon = defaultdict(set, {
-                            'Conj' : {'and', ConjunctorToken(), 'then'}
-                        })
-
-                        return self._read_parse_tree(node.left, lexicon, context) and self._read_parse_tree(node.right, lexicon, context)
-                    else:
-                        cmd = Command.from_parse_tree(node, context, include_group=False)
-
-                        if cmd != None:
-                            self.cmds.append(cmd)
-                            return True
-                        else:
-                            self.cmds = []
-                            return False
-                elif node.cat == 'ConjClause':
-                    return self._read_parse_tree(node.left, lexicon, context) and self._read_parse_tree(node.right, lexicon, context)
-
-            return False
+        if CommandGroup.max_workers > 1:
+            results = run_concurrently(self.cmds, CommandGroup.max_workers)
         else:
-            return node.data in lexicon[node.cat]
+            results = [cmd.exec() for cmd in self.cmds]
+
+        return '\n'.join(results)
+
+    def stream(self, out: 'text file'):
+        if CommandGroup.max_workers > 1:
+            # members run concurrently but their output has to come out in order, so each writes to a
+            # relay that holds it back until the members before it are done
+            relays = [OutputRelay(Command.spool_size) for cmd in self.cmds]
+
+            try:
+                run_concurrently(self.cmds, CommandGroup.max_workers,
+                    work=lambda i: self.cmds[i].stream(relays[i]),
+                    on_turn=lambda i: relays[i].go_live(out))
+            finally:
+                for relay in relays:
+                    relay.close()
+        else:
+            for cmd in self.cmds:
+                cmd.stream(out)
+
+
+Command.matcher = TreeMatcher([ListCommand, MoveCommand, CopyCommand, RemoveCommand, RawCommand, CommandGroup])
@@ -0,0 +1,89 @@
+'''Tab completion for Alfred's prompt: the words that can come next in a request, and paths inside
+backticks
+
+Every time completions are asked for, the line up to the word being completed is tokenized and
+the completer's prefix chart is brought up to date with it; since that only redoes the tokens
+that changed since last time (if anything did), completing stays about as fast at the end of a
+long line as at the start.'''
+
+from tok import tokenize, CommandInputToken, ConjunctorToken
+
+import glob
+import os
+
+try:
+    import readline
+except ImportError: # e.g. on Windows
+    readline = None
+
+
+class Completer:
+    def __init__(self, grammar: 'Grammar'):
+        self.chart = grammar.prefix_chart()
+        self.words = {} # category : the words it can be, as they'd be typed
+        self.matches = []
+        self.before = '' # the line before the word being completed, as of last time
+
+        for rule in grammar.lexicon:
+            if type(rule.rhs) == CommandInputToken:
+                word = '`'
+            elif type(rule.rhs) == ConjunctorToken:
+                word = ','
+            else:
+                word = rule.rhs
+
+            self.words.setdefault(rule.lhs, [])
+
+            if word not in self.words[rule.lhs]:
+                self.words[rule.lhs].append(word)
+
+    def install(self) -> bool:
+        '''Makes this the prompt's completer, if readline is available'''
+
+        if readline == None:
+            return False
+
+        readline.set_completer(self.complete)
+        readline.set_completer_delims(' `,')
+
+        if 'libedit' in (readline.__doc__ or ''):
+            readline.parse_and_bind('bind ^I rl_complete')
+        else:
+            readline.parse_and_bind('tab: complete')
+
+        return True
+
+    def complete(self, text: str, state: int) -> str:
+        # readline asks for each match in turn, starting from 0
+        if state == 0:
+            self.matches = self.suggestions(readline.get_line_buffer()[:readline.get_endidx()], text)
+
+        return self.matches[state] if state < len(self.matches) else None
+
+    def suggestions(self, line: str, text: str) -> [str]:
+        '''Completions of text, which ends the line typed so far'''
+
+        before = line[:len(line) - len(text)]
+
+        if before.count('`') % 2 == 1:
+            return Completer.paths(text)
+
+        # most keystrokes are partway through a word, which leaves everything before it as it was,
+        # and most others just finished one, which only adds to it
+        if before.startswith(self.before):
+            for tok in tokenize(before[len(self.before):].lower()):
+                self.chart.push(tok)
+        else:
+            self.chart.extend_to(tokenize(before.lower()))
+
+        self.before = before
+
+        text = text.lower()
+
+        return sorted({word for cat in self.chart.next_categories() for word in self.words.get(cat, ()) if word.startswith(text)})
+
+    def paths(text: str) -> [str]:
+        # directories get a slash so completion can carry on into them, files the closing backtick
+        paths = glob.glob(glob.escape(text) + '*')
+
+        return sorted(path + '/' if os.path.isdir(path) else path + '`' for path in paths)
@@ -0,0 +1,269 @@
+'''Keeps one warm Alfred in memory behind a Unix domain socket, so short-lived clients skip his startup
+
+The protocol is line-based: a client first sends its working directory, which relative paths in its
+requests are resolved against, then one sentence per line. For each one the daemon replies with
+Alfred's response a line at a time, followed by a line containing only ".". Response lines that
+start with "." get an extra "." in front, which the client strips back off.
+
+Run `python daemon.py --serve` to start the daemon, then `python daemon.py` for an interactive
+session or `python daemon.py "list \\`dir\\`" ...` to send sentences from a script.
+
+Only the user running the daemon can talk to it: the socket lives in a directory only they can get
+into ($XDG_RUNTIME_DIR, or a private one in the temp directory), and both ends check that whatever's
+at its path belongs to them before trusting it.'''
+
+from main import Alfred, QUIT_WORDS
+from commands import Context, working_dir
+
+import argparse
+import os
+import signal
+import socket
+import socketserver
+import stat
+import struct
+import sys
+import tempfile
+
+
+SOCKET_DIR = os.environ.get('XDG_RUNTIME_DIR') or os.path.join(tempfile.gettempdir(), f'alfred-{os.getuid()}')
+SOCKET_PATH = os.path.join(SOCKET_DIR, 'alfred.sock')
+
+END = '.'
+
+
+class ResponseWriter:
+    '''Writes a response in the protocol's format as it's produced; end() finishes it'''
+
+    def __init__(self, wfile: 'binary file'):
+        self.wfile = wfile
+        self.partial = '' # the last line, until its newline comes
+
+    def write(self, text: str):
+        lines = (self.partial + text).split('\n')
+        self.partial = lines.pop()
+
+        for line in lines:
+            self.write_line(line)
+
+    def flush(self):
+        self.wfile.flush()
+
+    def end(self):
+        if self.partial:
+            self.write_line(self.partial)
+            self.partial = ''
+
+        self.wfile.write(END.encode() + b'\n')
+        self.wfile.flush()
+
+    def write_line(self, line: str):
+        if line.startswith(END):
+            line = END + line
+
+        self.wfile.write(line.encode() + b'\n')
+
+
+def write_response(wfile: 'binary file', response: str):
+    writer = ResponseWriter(wfile)
+    writer.write(response + '\n')
+    writer.end()
+
+
+def read_lines(rfile: 'binary file') -> 'yields strs':
+    # a response's lines, as they arrive
+    for line in rfile:
+        line = line.decode().rstrip('\n')
+
+        if line == END:
+            return
+
+        yield line[1:] if line.startswith(END) else line
+
+    raise ConnectionError('Alfred hung up in the middle of a response')
+
+
+def read_response(rfile: 'binary file') -> str:
+    return '\n'.join(read_lines(rfile))
+
+
+def show_response(rfile: 'binary file', stream: bool):
+    if stream:
+        for line in read_lines(rfile):
+            print(line, flush=True)
+    else:
+        print(read_response(rfile))
+
+
+def check_owner(path: str, st: os.stat_result):
+    # another user could have put it there first, to be talked to (or talk to us) in our place
+    if st.st_uid != os.getuid():
+        raise PermissionError(f'{path} belongs to someone else; refusing to use it')
+
+
+def private_dir(path: str):
+    '''Makes sure the directory exists, and that only we can get into it'''
+
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    st = os.lstat(path)
+
+    if not stat.S_ISDIR(st.st_mode):
+        raise NotADirectoryError(f'{path} isn\'t a directory')
+
+    check_owner(path, st)
+
+    if st.st_mode & 0o077:
+        raise PermissionError(f'others can get into {path}; a socket there wouldn\'t be private')
+
+
+def peer_uid(sock: socket.socket) -> int:
+    # the uid of the process at the other end, where the platform can tell
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return None
+
+    creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+    return struct.unpack('3i', creds)[1]
+
+
+class SessionHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        uid = peer_uid(self.connection)
+
+        if uid != None and uid != os.getuid():
+            return
+
+        # each client gets its own memory, so "there" means its own last path, and its own directory
+        context = Context()
+        cwd = self.rfile.readline().decode().rstrip('\n')
+
+        if not os.path.isabs(cwd) or not os.path.isdir(cwd):
+            write_response(self.wfile, f'I can\'t work from {cwd!r}, it isn\'t a directory.')
+            return
+
+        working_dir.set(cwd)
+
+        for line in self.rfile:
+            sentence = line.decode().rstrip('\n')
+
+            if sentence.lower() in QUIT_WORDS:
+                write_response(self.wfile, 'Bye!')
+                break
+
+            if self.server.stream:
+                writer = ResponseWriter(self.wfile)
+                self.server.alfred.stream_response(sentence, writer, context)
+                writer.end()
+            else:
+                write_response(self.wfile, self.server.alfred.respond(sentence, context))
+
+
+class AlfredDaemon(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True # don't wait on idle clients when shutting down
+
+    def __init__(self, path: str, alfred: Alfred, stream: bool = False):
+        self.alfred = alfred
+        self.stream = stream # send command output to clients as it's produced
+
+        private_dir(os.path.dirname(path))
+
+        if os.path.lexists(path):
+            check_owner(path, os.lstat(path))
+
+            # a socket left behind by a daemon that didn't exit cleanly; refuse to steal a live one
+            try:
+                with socket.socket(socket.AF_UNIX) as probe:
+                    probe.connect(path)
+            except OSError:
+                os.unlink(path)
+            else:
+                raise OSError(f'Alfred is already listening on {path}')
+
+        # no one else should be able to connect, even for the moment before the chmod
+        umask = os.umask(0o077)
+
+        try:
+            super().__init__(path, SessionHandler)
+        finally:
+            os.umask(umask)
+
+        os.chmod(path, 0o600)
+
+    def server_close(self):
+        super().server_close()
+
+        try:
+            os.unlink(self.server_address)
+        except OSError:
+            pass
+
+
+def serve(path: str, stream: bool = False):
+    # exit (and clean up the socket) on kill just like on ^C
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit())
+
+    with AlfredDaemon(path, Alfred(), stream) as daemon:
+        try:
+            daemon.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+def ask(path: str, sentences: [str], stream: bool = False):
+    check_owner(path, os.stat(path))
+
+    with socket.socket(socket.AF_UNIX) as sock:
+        sock.connect(path)
+
+        uid = peer_uid(sock)
+
+        if uid != None and uid != os.getuid():
+            raise PermissionError(f'whoever is listening on {path} isn\'t you; refusing to talk to them')
+
+        with sock.makefile('rwb') as f:
+            write_line(f, os.getcwd())
+
+            if sentences:
+                for sentence in sentences:
+                    write_line(f, sentence)
+                    show_response(f, stream)
+            else:
+                # interactive, just like Alfred.serve
+                while True:
+                    sentence = input('    How can I help you?  ')
+                    print()
+
+                    write_line(f, sentence)
+                    show_response(f, stream)
+
+                    if sentence.lower() in QUIT_WORDS:
+                        break
+
+                print()
+
+
+def write_line(f: 'binary file', sentence: str):
+    f.write(sentence.replace('\n', ' ').encode() + b'\n')
+    f.flush()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Talk to (or run) a persistent Alfred daemon')
+    parser.add_argument('sentences', nargs='*', help='sentences to send; starts an interactive session if there are none')
+    parser.add_argument('--serve', action='store_true', help='run the daemon instead of a client')
+    parser.add_argument('--stream', action='store_true', help='show responses as they arrive; with --serve, send command output as it\'s produced')
+    parser.add_argument('--socket', default=SOCKET_PATH, help=f'socket path (default {SOCKET_PATH})')
+
+    args = parser.parse_args()
+
+    if args.serve:
+        try:
+            serve(args.socket, args.stream)
+        except PermissionError as e:
+            sys.exit(str(e))
+    else:
+        try:
+            ask(args.socket, args.sentences, args.stream)
+        except (FileNotFoundError, ConnectionRefusedError):
+            sys.exit(f'Alfred isn\'t running on {args.socket}; start him with `python daemon.py --serve`')
+        except PermissionError as e:
+            sys.exit(str(e))
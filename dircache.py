@@ -0,0 +1,93 @@
+'''An LRU cache of directory listings, so listing a big directory again doesn't read it all over again
+
+A listing is kept along with the directory's device, inode & mtime, and is only used while a stat of
+the directory still gives the same ones, which costs a single stat per hit however big the directory
+is. Since an mtime can't tell changes made within its granularity apart, a directory modified less
+than RACY_NS before it was read isn't cached; and anything Alfred changes himself is dropped as soon
+as he's done (see invalidate), whether or not its mtime would catch it.'''
+
+from collections import OrderedDict
+
+import os
+import threading
+import time
+
+
+# filesystems keep mtimes to as little as a second (or two, for FAT)
+RACY_NS = 2 * 10**9
+
+
+def normalize(path: str) -> str:
+    return os.path.normpath(os.path.abspath(path))
+
+
+class ListingCache:
+    def __init__(self, size: int = 128):
+        self.size = size
+        self.listings = OrderedDict() # path : ((device, inode, mtime), listing)
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def list(self, path: str, read: 'function') -> str:
+        '''The directory's listing, from read(path) if it isn't cached (or has changed since it was)'''
+
+        key = normalize(path)
+        st = os.stat(path)
+        version = (st.st_dev, st.st_ino, st.st_mtime_ns)
+
+        with self.lock:
+            cached = self.listings.get(key)
+
+            if cached != None and cached[0] == version:
+                self.hits += 1
+                self.listings.move_to_end(key)
+                return cached[1]
+
+            self.misses += 1
+
+        started = time.time_ns()
+        listing = read(path)
+
+        if version[2] < started - RACY_NS:
+            with self.lock:
+                self.listings[key] = (version, listing)
+                self.listings.move_to_end(key)
+
+                if len(self.listings) > self.size:
+                    self.listings.popitem(last=False)
+                    self.evictions += 1
+
+        return listing
+
+    def invalidate(self, path: str):
+        '''Drops the listings a change to path could affect: its own, everything under it, and the
+        directory it's in'''
+
+        key = normalize(path)
+        inside = key.rstrip(os.sep) + os.sep
+
+        with self.lock:
+            stale = [cached for cached in self.listings if cached == key or cached.startswith(inside) or cached == os.path.dirname(key)]
+
+            for cached in stale:
+                del self.listings[cached]
+
+            self.invalidations += len(stale)
+
+    def clear(self):
+        with self.lock:
+            self.listings.clear()
+
+    def stats(self) -> dict:
+        return {
+            'size' : len(self.listings),
+            'capacity' : self.size,
+            'hits' : self.hits,
+            'misses' : self.misses,
+            'evictions' : self.evictions,
+            'invalidations' : self.invalidations,
+        }
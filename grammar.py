@@ -1,15 +1,58 @@
-from collections import defaultdict
-from tok import Token, tokenize
+from collections import defaultdict, deque, OrderedDict
+from tok import Token, vocabulary, tokenize
+import instrument
+
+import heapq
+import math
+import threading
+
+np = None # numpy is optional, and only imported once a grammar asks for the 'numpy' parser backend
+
+def import_numpy():
+    # importing numpy takes far longer than building a grammar, so it's kept off the startup path
+    global np
+
+    if np == None:
+        try:
+            import numpy
+        except ImportError:
+            raise ImportError("the 'numpy' parser backend requires numpy to be installed")
+
+        np = numpy
 
 class SyntaxRule:
     def __init__(self, lhs: str, rhs1: str, rhs2: str, p: float):
         self.lhs = lhs
         self.rhs1 = rhs1
         self.rhs2 = rhs2
+        self.rhs = (rhs1, rhs2)
         self.p = p
 
+    def with_rhs(lhs: str, rhs: [str], p: float) -> 'SyntaxRule':
+        '''A rule with any number of categories on its right-hand side, which only the 'earley'
+        backend can parse with unless there are 2'''
+
+        if len(rhs) == 0:
+            raise ValueError(f'a rule for {lhs} needs at least 1 category on its right-hand side')
+
+        rule = SyntaxRule(lhs, rhs[0], rhs[1] if len(rhs) > 1 else None, p)
+        rule.rhs = tuple(rhs)
+
+        return rule
+
+    def from_list(rule: list) -> 'SyntaxRule':
+        '''Inverse of as_list'''
+
+        return SyntaxRule.with_rhs(*rule) if len(rule) == 3 else SyntaxRule(*rule)
+
+    def is_binary(self) -> bool:
+        return len(self.rhs) == 2
+
     def as_list(self) -> list:
-        return [self.lhs, self.rhs1, self.rhs2, self.p]
+        if self.is_binary():
+            return [self.lhs, self.rhs1, self.rhs2, self.p]
+        else:
+            return [self.lhs, list(self.rhs), self.p]
 
 
 class LexicalRule:
@@ -23,12 +66,19 @@ class LexicalRule:
 
 
 class ParseTreeNode:
-    def __init__(self, data: Token, cat: str, left: 'ParseTreeNode' = None, right: 'ParseTreeNode' = None):
+    def __init__(self, data: Token, cat: str, left: 'ParseTreeNode' = None, right: 'ParseTreeNode' = None, rest: tuple = ()):
         self.left = left
         self.right = right
+        self.rest = rest # any children after the first two, for rules with more than 2
         self.data = data
         self.cat = cat
 
+    def branch(cat: str, children: ['ParseTreeNode']) -> 'ParseTreeNode':
+        return ParseTreeNode(None, cat, children[0], children[1] if len(children) > 1 else None, tuple(children[2:]))
+
+    def children(self) -> ['ParseTreeNode']:
+        return [child for child in (self.left, self.right) if child != None] + list(self.rest)
+
     def __repr__(self) -> str:
         return self.traverse()
 
@@ -36,13 +86,376 @@ class ParseTreeNode:
         if self.left == None and self.right == None:
             return repr(self.data)
         else:
-            return f'{self.left.traverse()} {self.right.traverse()}'
+            return ' '.join(child.traverse() for child in self.children())
+
+
+class ChartEntry:
+    '''Backpointer for the best way found so far to build a category over a chart span'''
+
+    __slots__ = ('m', 'e', 'split', 'left', 'right')
+
+    def __init__(self, m: float, e: int, split: int = None, left: int = None, right: int = None):
+        self.update(m, e, split, left, right)
+
+    def update(self, m: float, e: int, split: int, left: int, right: int):
+        self.m = m # probability m * 2**e, with m in [0.5, 1)
+        self.e = e
+        self.split = split # None for lexical entries
+        self.left = left   # category ids of the children
+        self.right = right
+
+
+class ParseCache:
+    '''LRU cache of parse trees keyed on sentence shape, i.e. the tokens with each command input replaced by a slot'''
+
+    def __init__(self, size: int):
+        self.size = size
+        self.trees = OrderedDict()
+        self.lock = threading.Lock() # grammars may be shared between threads, e.g. by the daemon
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def key(tokens: [Token]) -> tuple:
+        # command inputs all share one symbol, so they only matter by position; unknown words all
+        # share one too, which is fine since none of them can be parsed anyway
+        return tuple(tok.sym for tok in tokens)
+
+    def lookup(self, tokens: [Token]) -> (bool, ParseTreeNode):
+        '''Returns whether the sentence's shape was cached, and if so its tree rebound to the sentence's own tokens'''
+
+        key = ParseCache.key(tokens)
+
+        with self.lock:
+            if key not in self.trees:
+                self.misses += 1
+                return False, None
+
+            self.hits += 1
+            self.trees.move_to_end(key)
+
+            tree = self.trees[key]
+
+        return True, ParseCache.rebind(tree, iter(tokens)) if tree != None else None
+
+    def store(self, tokens: [Token], tree: ParseTreeNode):
+        key = ParseCache.key(tokens)
+
+        with self.lock:
+            self.trees[key] = tree
+
+            if len(self.trees) > self.size:
+                self.trees.popitem(last=False)
+                self.evictions += 1
+
+    def rebind(tree: ParseTreeNode, tokens: 'iterator of tokens') -> ParseTreeNode:
+        # leaves appear in the same order as the tokens they were built from
+        if tree.data != None:
+            return ParseTreeNode(next(tokens), tree.cat)
+
+        return ParseTreeNode.branch(tree.cat, [ParseCache.rebind(child, tokens) for child in tree.children()])
+
+    def clear(self):
+        with self.lock:
+            self.trees.clear()
+
+    def stats(self) -> dict:
+        return {
+            'size' : len(self.trees),
+            'capacity' : self.size,
+            'hits' : self.hits,
+            'misses' : self.misses,
+            'evictions' : self.evictions,
+        }
+
+
+class PrefixChart:
+    '''Which categories span which parts of a sentence, ignoring how likely they are, built a token
+    at a time (and cut back the same way), so a sentence that's still being typed never has
+    anything already worked out redone'''
+
+    def __init__(self, grammar: 'Grammar'):
+        self.grammar = grammar
+        self.tokens = []
+
+        # bitmasks: ends[i][y] has bit k set if y spans i..k, starts[k][z] bit i if z spans i..k,
+        # columns[k][i] the categories spanning i..k, and begins[i] those spanning anything from i
+        self.ends = []
+        self.starts = []
+        self.columns = []
+        self.begins = []
+
+        # the categories that can start at each position, given everything before it
+        s = grammar.category_ids.get('S')
+        self.predictions = [grammar.left_corners[s] if s != None else 0]
+
+    def push(self, tok: Token):
+        grammar = self.grammar
+        c = len(grammar.categories)
+        k = len(self.tokens)
+
+        self.tokens.append(tok)
+        self.ends.append([0] * c)
+        self.starts.append([0] * c)
+        self.columns.append([0] * (k + 1))
+        self.begins.append(0)
+
+        self.add(k, k, grammar.lexical_masks.get(tok.sym, 0))
+
+        if not self.columns[k][k]:
+            return # nothing spans up to a word no category has
+
+        starts = self.starts[k]
+
+        # longer spans end up using shorter ones on their right, so those are done first
+        for i in range(k - 1, -1, -1):
+            ends = self.ends[i]
+            found = 0
+
+            for y in grammar.category_bits(self.begins[i]):
+                # splits j where y spans i..j, as bits j + 1 to line up with where the right child starts
+                lefts = ends[y] << 1
+
+                for z, lhs in grammar.rules_by_left[y]:
+                    if lhs & ~found and lefts & starts[z]:
+                        found |= lhs
+
+            if found:
+                self.add(i, k, found)
+
+    def add(self, i: int, k: int, found: int):
+        self.columns[k][i] = found
+        self.begins[i] |= found
+
+        for x in self.grammar.category_bits(found):
+            self.ends[i][x] |= 1 << k
+            self.starts[k][x] |= 1 << i
+
+    def pop(self):
+        k = len(self.tokens) - 1
+
+        for i, found in enumerate(self.columns[k]):
+            if found:
+                for x in self.grammar.category_bits(found):
+                    self.ends[i][x] &= ~(1 << k)
+
+                self.begins[i] = sum(1 << y for y, ends in enumerate(self.ends[i]) if ends)
+
+        del self.tokens[k], self.ends[k], self.starts[k], self.columns[k], self.begins[k]
+        del self.predictions[k + 1:]
+
+    def extend_to(self, tokens: [Token]):
+        '''Pops back to where the tokens stop matching the chart's, then pushes the rest of them'''
+
+        same = 0
+
+        while same < min(len(tokens), len(self.tokens)) and tokens[same].sym == self.tokens[same].sym:
+            same += 1
+
+        while len(self.tokens) > same:
+            self.pop()
+
+        for tok in tokens[same:]:
+            self.push(tok)
+
+    def is_sentence(self) -> bool:
+        s = self.grammar.category_ids.get('S')
+        return s != None and len(self.tokens) > 0 and self.ends[0][s] >> (len(self.tokens) - 1) & 1 == 1
+
+    def next_categories(self) -> [str]:
+        '''The lexical categories the next token could have, for the tokens so far to still be the
+        start of a sentence'''
+
+        grammar = self.grammar
+
+        # each position's predictions only depend on what's before it, so they're kept until popped
+        for k in range(len(self.predictions) - 1, len(self.tokens)):
+            following = 0
+
+            for i, spanned in enumerate(self.columns[k]):
+                if spanned:
+                    for a in grammar.category_bits(self.predictions[i]):
+                        for y, z in grammar.rules_by_lhs[a]:
+                            if spanned >> y & 1:
+                                following |= grammar.left_corners[z]
+
+            self.predictions.append(following)
+
+        return [grammar.categories[x] for x in grammar.category_bits(self.predictions[-1] & grammar.lexical_categories)]
 
 
 class Grammar:
-    def __init__(self, syntax: [SyntaxRule], lexicon: [LexicalRule]):
+    backends = ('python', 'numpy', 'agenda', 'earley')
+    no_exponent = -(1 << 60) # of an empty chart cell, so any sum involving one stays below every real exponent
+
+    def __init__(self, syntax: [SyntaxRule], lexicon: [LexicalRule], backend: str = 'python', cache_size: int = None,
+                 split_clauses: bool = False, workers: int = None, beam: int = None, threshold: float = None):
+        if backend not in Grammar.backends:
+            raise ValueError(f'unknown parser backend {backend!r}')
+        elif backend == 'numpy':
+            import_numpy()
+
+        if beam != None and beam < 1:
+            raise ValueError('the beam must keep at least 1 category per chart cell')
+        elif threshold != None and not 0 < threshold <= 1:
+            raise ValueError('the threshold must be a ratio in (0, 1]')
+        elif backend in ('agenda', 'earley') and (beam != None or threshold != None):
+            raise ValueError(f"the {backend!r} backend doesn't prune, since it only ever builds what it needs")
+        elif backend != 'earley' and not all(rule.is_binary() for rule in syntax):
+            raise ValueError(f"the {backend!r} backend only parses with binary rules; the 'earley' backend parses with any")
+
         self.syntax = syntax
         self.lexicon = lexicon
+        self.backend = backend
+        self.cache = ParseCache(cache_size) if cache_size else None
+
+        # chart cells only keep the best beam categories, and those at least threshold times as likely as the best
+        self.beam = beam
+        self.threshold = threshold
+        self.log_threshold = math.log2(threshold) if threshold != None else None
+
+        self._compile()
+        self._compile_masks()
+
+        if self.backend == 'earley':
+            self._compile_earley()
+
+        # sentences are only split into clauses if the grammar joins clauses in a way that allows it
+        self.split_clauses = split_clauses
+        self.conjunctions = self._find_conjunctions()
+
+        self.workers = workers
+        self.pool = None
+        self.pool_lock = threading.Lock()
+
+    def from_dict(data: dict, **options) -> 'Grammar':
+        '''Inverse of as_dict'''
+
+        syntax = [SyntaxRule.from_list(rule) for rule in data['syntax']]
+        lexicon = [LexicalRule(*rule) for rule in data['lexicon']]
+
+        return Grammar(syntax, lexicon, **options)
+
+    def _compile(self):
+        '''Number the categories and index the rules so parsing only looks at rules that can actually apply'''
+
+        self.categories = []
+        self.category_ids = {}
+
+        for cat in [x for rule in self.syntax for x in (rule.lhs, *rule.rhs)] + [rule.lhs for rule in self.lexicon]:
+            if cat not in self.category_ids:
+                self.category_ids[cat] = len(self.categories)
+                self.categories.append(cat)
+
+        # binary rules by (rhs1, rhs2), keeping each rule's position so ties resolve like a full scan
+        self.binary_index = defaultdict(list)
+
+        for order, rule in enumerate(self.syntax):
+            if not rule.is_binary():
+                continue
+
+            self.binary_index[self.category_ids[rule.rhs1], self.category_ids[rule.rhs2]].append((order, self.category_ids[rule.lhs], rule.p))
+
+        # lexical rules by the interned symbol of the word they match
+        self.lexical_index = defaultdict(list)
+
+        for rule in self.lexicon:
+            self.lexical_index[vocabulary.intern(rule.rhs)].append((self.category_ids[rule.lhs], rule.p))
+
+        if self.backend == 'numpy':
+            self._compile_arrays()
+
+    def _find_conjunctions(self) -> (str, str, set):
+        '''Finds the rules S -> S Y & Y -> C S joining clauses with a conjunction C, and the symbols of
+        the words that can only be a C, or None if there are no such rules or anything else uses Y or C'''
+
+        for join in self.syntax:
+            if join.lhs != 'S' or join.rhs1 != 'S' or not join.is_binary():
+                continue
+
+            for clause in self.syntax:
+                if clause.lhs != join.rhs2 or clause.rhs2 != 'S' or clause.rhs1 in ('S', join.rhs2) or not clause.is_binary():
+                    continue
+
+                # then every C in a sentence starts a Y, and every Y is a clause joined onto the sentence
+                # before it, so splitting at the Cs can't lose a parse
+                uses = [rule for rule in self.syntax if {join.rhs2, clause.rhs1} & {rule.lhs, *rule.rhs}]
+
+                if len(uses) != 2:
+                    continue
+
+                c = self.category_ids[clause.rhs1]
+                syms = {sym for sym, entries in self.lexical_index.items() if entries and all(x == c for x, _ in entries)}
+
+                return join.rhs2, clause.rhs1, syms
+
+        return None
+
+    def _compile_masks(self):
+        '''Index the binary rules by category id for recognizing sentences with bitmasks'''
+
+        self.rules_by_left = [[] for _ in self.categories] # y : [(z, bits of every x -> y z)]
+        self.rules_by_lhs = [[] for _ in self.categories]  # x : [(y, z) of every x -> y z]
+        self.mask_ids = {}
+
+        lhs_bits = defaultdict(int)
+
+        for (y, z), rules in self.binary_index.items():
+            for _, x, p in rules:
+                if p > 0:
+                    lhs_bits[y, z] |= 1 << x
+                    self.rules_by_lhs[x].append((y, z))
+
+        for (y, z), bits in lhs_bits.items():
+            self.rules_by_left[y].append((z, bits))
+
+        self.lexical_masks = defaultdict(int)
+
+        for sym, rules in self.lexical_index.items():
+            for x, p in rules:
+                if p > 0:
+                    self.lexical_masks[sym] |= 1 << x
+
+        self.lexical_categories = 0
+
+        for bits in self.lexical_masks.values():
+            self.lexical_categories |= bits
+
+        # the categories that can start each category (itself included), for predicting what comes next
+        self.left_corners = [1 << x for x in range(len(self.categories))]
+        changed = True
+
+        while changed:
+            changed = False
+
+            for x, rules in enumerate(self.rules_by_lhs):
+                corners = self.left_corners[x]
+
+                for y, _ in rules:
+                    corners |= self.left_corners[y]
+
+                if corners != self.left_corners[x]:
+                    self.left_corners[x] = corners
+                    changed = True
+
+    def _compile_arrays(self):
+        '''Lay the binary rules out as parallel arrays for the numpy backend'''
+
+        # rules are kept grouped by lhs (stable, so grammar order is preserved within each group)
+        ordered = sorted(self.syntax, key=lambda rule: self.category_ids[rule.lhs])
+
+        self.rule_lhs = np.array([self.category_ids[rule.lhs] for rule in ordered], dtype=np.intp)
+        self.rule_rhs1 = np.array([self.category_ids[rule.rhs1] for rule in ordered], dtype=np.intp)
+        self.rule_rhs2 = np.array([self.category_ids[rule.rhs2] for rule in ordered], dtype=np.intp)
+        self.rule_p = np.array([rule.p for rule in ordered], dtype=np.float64)
+
+        # (lhs, first rule, end of rules) for each group
+        self.rule_groups = []
+
+        for x in np.unique(self.rule_lhs):
+            xs = np.flatnonzero(self.rule_lhs == x)
+            self.rule_groups.append((x, xs[0], xs[-1] + 1))
 
     def as_dict(self) -> dict:
         return {
@@ -58,41 +471,724 @@ class Grammar:
         for rule in self.syntax:
             yield rule.as_list()
 
+    def sample(self, rng: 'random.Random', cat: str = 'S', depth: int = 16) -> list:
+        '''A random phrase of category cat, picking each rule by its probability: the words (and
+        placeholder tokens) of the lexical rules it ends in, or None if it nests deeper than depth'''
+
+        if depth == 0:
+            return None
+
+        rules = [rule for rule in self.syntax if rule.lhs == cat]
+        words = [rule for rule in self.lexicon if rule.lhs == cat]
+        rule = rng.choices(rules + words, [rule.p for rule in rules + words])[0]
+
+        if type(rule) == LexicalRule:
+            return [rule.rhs]
+
+        phrase = []
+
+        for x in rule.rhs:
+            part = self.sample(rng, x, depth - 1)
+
+            if part == None:
+                return None
+
+            phrase += part
+
+        return phrase
+
     def parse(self, sentence: str) -> ParseTreeNode:
         '''Implementation of CYK Parse to parse (tokenized) input sentences'''
 
-        tokens = tokenize(sentence.lower())
+        return self.parse_tokens(tokenize(sentence.lower()))
+
+    def parse_tokens(self, tokens: [Token]) -> ParseTreeNode:
+        '''Parses a sentence that's already been tokenized (and lowercased)'''
+
+        if self.cache != None:
+            hit, tree = self.cache.lookup(tokens)
+
+            if hit:
+                return tree
+
+        tree = self._parse_clauses(tokens) if self.split_clauses and self.conjunctions != None else None
+
+        if tree == None:
+            tree = self._parse(tokens)
+
+        if self.cache != None:
+            self.cache.store(tokens, tree)
+
+        return tree
+
+    def _parse(self, tokens: [Token]) -> ParseTreeNode:
+        if self.backend == 'numpy':
+            return self._parse_numpy(tokens)
+        elif self.backend == 'agenda':
+            return self._parse_agenda(tokens)
+        elif self.backend == 'earley':
+            return self._parse_earley(tokens)
+        else:
+            return self._parse_python(tokens)
+
+    def parse_ahead(self, sentences: 'iterable of strs', ahead: int = 64) -> 'yields (str, [Token], ParseTreeNode, dict)':
+        '''Parses the sentences, yielding each in turn with its tokens & tree, while up to ahead sentences
+        after it are already being parsed: on the grammar's worker processes if it has any, otherwise
+        on a thread of its own (which still keeps parsing while whoever's asking waits on something else)
+
+        Each also comes with the numbers tokenizing & parsing it ran up if stats are being kept (see
+        instrument.measured), for its request to take in.'''
+
+        if self.workers != None:
+            pool = self.clause_pool()
+            work = parse_sentence
+        else:
+            from concurrent.futures import ThreadPoolExecutor # see clause_pool
+
+            pool = ThreadPoolExecutor(1)
+            work = self.parse_tokens
+
+        pending = deque()
+        sentences = iter(sentences)
+
+        try:
+            while True:
+                for sentence in sentences:
+                    tokens, numbers = instrument.measured('tokenize', tokenize, sentence.lower())
+                    pending.append((sentence, tokens, numbers, pool.submit(instrument.measured, 'parse', work, tokens)))
+
+                    if len(pending) >= ahead:
+                        break
+
+                if not pending:
+                    return
+
+                sentence, tokens, numbers, future = pending.popleft()
+                tree, parse_numbers = future.result()
+
+                if numbers != None and parse_numbers != None:
+                    instrument.add_up(numbers, parse_numbers)
+
+                if tree != None and self.workers != None:
+                    # leaves come back as copies, so they're swapped for the sentence's own tokens
+                    tree = ParseCache.rebind(tree, iter(tokens))
+
+                yield sentence, tokens, tree, numbers
+        finally:
+            for *_, future in pending:
+                future.cancel()
+
+            if self.workers == None:
+                pool.shutdown()
+
+    def _parse_clauses(self, tokens: [Token]) -> ParseTreeNode:
+        '''Parses each clause of a sentence on its own, splitting it at its conjunctions, and joins them
+        into one right-branching tree; returns None if it doesn't split into clauses that all parse'''
+
+        joiner, conj, syms = self.conjunctions
+        clauses = [[]]
+        conjunctions = []
+
+        for tok in tokens:
+            if tok.sym in syms:
+                conjunctions.append(tok)
+                clauses.append([])
+            else:
+                clauses[-1].append(tok)
+
+        if len(clauses) == 1 or not all(clauses):
+            return None
+
+        if self.workers != None:
+            pool = self.clause_pool()
+            trees = list(pool.map(parse_clause, clauses, chunksize=-(-len(clauses) // self.workers)))
+
+            # leaves come back as copies, so they're swapped for the sentence's own tokens
+            trees = [ParseCache.rebind(tree, iter(clause)) if tree != None else None for tree, clause in zip(trees, clauses)]
+        else:
+            trees = [self._parse_clause(clause) for clause in clauses]
+
+        if any(tree == None for tree in trees):
+            return None
+
+        # S -> S Y, Y -> C S, nested to the right; every way of grouping the clauses is equally likely,
+        # and this is the one a parse of the whole sentence picks (up to rounding)
+        tree = trees[-1]
+
+        for clause, tok in zip(reversed(trees[:-1]), reversed(conjunctions)):
+            tree = ParseTreeNode(None, 'S', clause, ParseTreeNode(None, joiner, ParseTreeNode(tok, conj), tree))
+
+        return tree
+
+    def _parse_clause(self, tokens: [Token]) -> ParseTreeNode:
+        # clauses go through the cache too, since long requests tend to repeat them
+        if self.cache != None:
+            hit, tree = self.cache.lookup(tokens)
+
+            if hit:
+                return tree
+
+        tree = self._parse(tokens)
+
+        if self.cache != None:
+            self.cache.store(tokens, tree)
+
+        return tree
+
+    def clause_pool(self) -> 'ProcessPoolExecutor':
+        # worker processes are only started once there's a sentence to split (or to parse ahead)
+        with self.pool_lock:
+            if self.pool == None:
+                # concurrent.futures pulls in multiprocessing & logging, which would add more to Alfred's
+                # startup than everything else he imports, so it's only imported once it's needed
+                from concurrent.futures import ProcessPoolExecutor
+
+                options = {'backend': self.backend, 'beam': self.beam, 'threshold': self.threshold, 'split_clauses': self.split_clauses}
+                self.pool = ProcessPoolExecutor(self.workers, initializer=start_clause_worker, initargs=(self.as_dict(), options))
+
+            return self.pool
+
+    def close(self):
+        with self.pool_lock:
+            if self.pool != None:
+                self.pool.shutdown()
+                self.pool = None
+
+    def _parse_python(self, tokens: [Token]) -> ParseTreeNode:
         l = len(tokens)
 
-        trees = {}
-        probabilities = defaultdict(int)
+        # only the categories that can be part of a parse of the whole sentence are scored
+        needed = self._reachable(tokens)
+
+        if needed == None:
+            return None
+
+        # chart[i][k] maps the id of each category spanning tokens i..k to its best ChartEntry,
+        # and is left as None until something actually spans i..k; probabilities are kept as
+        # mantissa & exponent, since products over a long sentence would underflow, and scaling by
+        # powers of 2 is exact, so they round just like the plain products
+        chart = [[None] * l for _ in range(l)]
 
         for i, tok in enumerate(tokens):
-            for x, y, p in self.lexical_rules():
-                if y == tok:
-                    probabilities[x, i, i] = p
-                    trees[x, i, i] = ParseTreeNode(tok, x)
+            chart[i][i] = {x: ChartEntry(*math.frexp(p)) for x, p in self.lexical_index.get(tok.sym, ()) if p > 0 and needed[i][i] >> x & 1}
 
-        for i, j, k in self.subspans(l):
-            for x, y, z, p in self.syntax_rules():
-                p_yz = probabilities[y, i, j] * probabilities[z, j + 1, k] * p
+        pruning = self.beam != None or self.threshold != None
+        tried = 0 # rules that could make a category from two others the sentence has next to each other
 
-                if p_yz > probabilities[x, i, k]:
-                    probabilities[x, i, k] = p_yz
-                    trees[x, i, k] = ParseTreeNode(None, x, trees[y, i, j], trees[z, j + 1, k])
+        for length in range(2, l + 1):
+            if pruning:
+                # every shorter span is done
+                for a in range(l - length + 2):
+                    if chart[a][a + length - 2]:
+                        self._prune(chart[a][a + length - 2])
 
-        for data, tree in trees.items():
-            x, i, j = data
+            for i in range(l + 1 - length):
+                if needed[i][i + length - 1]:
+                    tried += self._fill_cell(chart, needed, i, i + length - 1)
 
-            if i == 0 and j == l - 1 and x == 'S':
-                return tree
+        if instrument.active != None:
+            instrument.active.count('chart cells filled', sum(cell != None for row in chart for cell in row))
+            instrument.active.count('rules tried', tried)
+
+        s = self.category_ids.get('S')
+
+        if l > 0 and chart[0][l - 1] != None and s in chart[0][l - 1]:
+            return self._build_tree(chart, tokens, s, 0, l - 1)
 
         return None
 
-    def subspans(self, n: int) -> (int, int, int):
-        for l in range(2, n + 1):
+    def _recognize(self, tokens: [Token]) -> PrefixChart:
+        '''Where each category spans the tokens, ignoring how likely it is, or None if S doesn't span
+        all of them (i.e. the sentence has no parse)'''
+
+        chart = self.prefix_chart(tokens)
+        return chart if chart.is_sentence() else None
+
+    def prefix_chart(self, tokens: [Token] = ()) -> PrefixChart:
+        if not all(rule.is_binary() for rule in self.syntax):
+            raise ValueError('prefix charts only work with binary rules')
+
+        chart = PrefixChart(self)
+
+        for tok in tokens:
+            chart.push(tok)
+
+        return chart
+
+    def _reachable(self, tokens: [Token], split_lengths: dict = None) -> [[int]]:
+        '''The categories spanning each i..k that are part of some parse of the whole sentence (as
+        bitmasks), working down from S over all of it, or None if there's no parse
+
+        If split_lengths is given, it gets a bitmask for each span length of the lengths of the left
+        children any of those spans can have (bit a for a left child a tokens long).'''
+
+        chart = self._recognize(tokens)
+
+        if chart == None:
+            return None
+
+        ends, starts = chart.ends, chart.starts
+        n = len(tokens)
+        needed = [[0] * n for _ in range(n)]
+        needed[0][n - 1] = 1 << self.category_ids['S']
+
+        for l in range(n, 1, -1):
             for i in range(n + 1 - l):
                 k = i + l - 1
 
-                for j in range(i, k):
-                    yield (i, j, k)
+                if not needed[i][k]:
+                    continue
+
+                for x in self.category_bits(needed[i][k]):
+                    for y, z in self.rules_by_lhs[x]:
+                        # bits j + 1 for the splits j where y spans i..j and z spans j + 1..k
+                        splits = (ends[i][y] << 1) & starts[k][z]
+
+                        if split_lengths != None and splits:
+                            split_lengths[l] = split_lengths.get(l, 0) | splits >> i
+
+                        while splits:
+                            low = splits & -splits
+                            j = low.bit_length() - 2
+                            splits ^= low
+
+                            needed[i][j] |= 1 << y
+                            needed[j + 1][k] |= 1 << z
+
+        return needed
+
+    def category_bits(self, mask: int) -> tuple:
+        # the category ids in a bitmask; cells only ever hold a few distinct sets, so they're cached
+        ids = self.mask_ids.get(mask)
+
+        if ids == None:
+            ids = self.mask_ids[mask] = tuple(x for x in range(mask.bit_length()) if mask >> x & 1)
+
+        return ids
+
+    def _fill_cell(self, chart: [[dict]], needed: [[int]], i: int, k: int) -> int:
+        # returns how many rules it tried
+        need = needed[i][k]
+        tried = 0
+
+        for j in range(i, k):
+            left = chart[i][j]
+            right = chart[j + 1][k]
+
+            if not left or not right:
+                continue
+
+            # only visit rules whose children are actually present in the two cells
+            candidates = []
+
+            for y, entry_y in left.items():
+                for z, entry_z in right.items():
+                    e_yz = entry_y.e + entry_z.e
+
+                    for order, x, p in self.binary_index.get((y, z), ()):
+                        if need >> x & 1:
+                            candidates.append((order, x, entry_y.m * entry_z.m * p, e_yz, y, z))
+
+            if not candidates:
+                continue
+
+            tried += len(candidates)
+            cell = chart[i][k]
+
+            if cell == None:
+                cell = chart[i][k] = {}
+
+            candidates.sort(key=lambda c: c[0])
+
+            for _, x, m, e, y, z in candidates:
+                if m == 0:
+                    continue
+
+                m, shift = math.frexp(m)
+                e += shift
+                entry = cell.get(x)
+
+                if entry == None:
+                    cell[x] = ChartEntry(m, e, j, y, z)
+                elif e > entry.e or (e == entry.e and m > entry.m):
+                    entry.update(m, e, j, y, z)
+
+        return tried
+
+    def _prune(self, cell: dict):
+        if self.threshold == None and len(cell) <= self.beam:
+            return
+
+        ranked = sorted(cell.items(), key=lambda item: (item[1].e, item[1].m, -item[0]), reverse=True)
+        kept = ranked[:self.beam] if self.beam != None else ranked
+
+        if self.threshold != None:
+            best = ranked[0][1]
+            floor = math.log2(best.m) + best.e + self.log_threshold
+
+            kept = [(x, entry) for x, entry in kept if math.log2(entry.m) + entry.e >= floor]
+
+        if len(kept) < len(cell):
+            cell.clear()
+            cell.update(kept)
+
+    def _parse_agenda(self, tokens: [Token]) -> ParseTreeNode:
+        '''Best-first search: builds (span, category) items most likely first, stopping as soon as one
+        for S over the whole sentence is done; since no rule makes an item more likely than its
+        children, each is at its best the first time it comes off the agenda'''
+
+        n = len(tokens)
+        s = self.category_ids.get('S')
+
+        if n == 0 or s == None:
+            return None
+
+        # agenda entries are (-e, -m, split, rule order, i, k, x, y, z), so the most likely comes first,
+        # and ties go to the split & rule a full CYK chart would have kept
+        agenda = []
+        pending = {} # (i, k, x) : the best agenda key it's been pushed with
+
+        for i, tok in enumerate(tokens):
+            for x, p in self.lexical_index.get(tok.sym, ()):
+                if p > 0:
+                    m, e = math.frexp(p)
+                    key = (-e, -m, -1, -1)
+
+                    if key < pending.get((i, i, x), (math.inf,)):
+                        pending[i, i, x] = key
+                        heapq.heappush(agenda, (*key, i, i, x, None, None))
+
+        chart = [[None] * n for _ in range(n)] # done items, like _parse_python's chart
+        starting = [[] for _ in range(n)]      # (k, x) of the done items starting at each token...
+        ending = [[] for _ in range(n)]        # ...and (i, x) of the ones ending at it
+
+        while agenda:
+            ne, nm, j, _, i, k, x, y, z = heapq.heappop(agenda)
+
+            if chart[i][k] != None and x in chart[i][k]:
+                continue
+
+            if chart[i][k] == None:
+                chart[i][k] = {}
+
+            entry = chart[i][k][x] = ChartEntry(-nm, -ne, j if j >= 0 else None, y, z)
+
+            if i == 0 and k == n - 1 and x == s:
+                return self._build_tree(chart, tokens, s, 0, n - 1)
+
+            starting[i].append((k, x))
+            ending[k].append((i, x))
+
+            # every item the new one can build alongside one that's already done
+            combinations = []
+
+            if k + 1 < n:
+                combinations += [(i, k, k2, x, z2, entry, chart[k + 1][k2][z2]) for k2, z2 in starting[k + 1]]
+
+            if i > 0:
+                combinations += [(i2, i - 1, k, y2, x, chart[i2][i - 1][y2], entry) for i2, y2 in ending[i - 1]]
+
+            for i2, j2, k2, y2, z2, entry_y, entry_z in combinations:
+                for order, x2, p in self.binary_index.get((y2, z2), ()):
+                    m, shift = math.frexp(entry_y.m * entry_z.m * p)
+
+                    if m == 0 or (chart[i2][k2] != None and x2 in chart[i2][k2]):
+                        continue
+
+                    key = (-(entry_y.e + entry_z.e + shift), -m, j2, order)
+
+                    if key < pending.get((i2, k2, x2), (math.inf,)):
+                        pending[i2, k2, x2] = key
+                        heapq.heappush(agenda, (*key, i2, k2, x2, y2, z2))
+
+        return None
+
+    def _compile_earley(self):
+        '''Index the rules by what they make, for the earley backend's predictions'''
+
+        self.earley_rules = [] # (lhs, rhs, p, order)
+        self.rules_making = [[] for _ in self.categories]
+
+        for order, rule in enumerate(self.syntax):
+            if rule.p > 0:
+                self.rules_making[self.category_ids[rule.lhs]].append(len(self.earley_rules))
+                self.earley_rules.append((self.category_ids[rule.lhs], tuple(self.category_ids[x] for x in rule.rhs), rule.p, order))
+
+        # predicting a category predicts everything that can start it too, so that's worked out once
+        corners = [1 << x for x in range(len(self.categories))]
+        changed = True
+
+        while changed:
+            changed = False
+
+            for lhs, rhs, _, _ in self.earley_rules:
+                if corners[lhs] | corners[rhs[0]] != corners[lhs]:
+                    corners[lhs] |= corners[rhs[0]]
+                    changed = True
+
+        self.earley_corners = corners
+
+    def _parse_earley(self, tokens: [Token]) -> ParseTreeNode:
+        '''Earley parsing, left to right, with Viterbi scores: each state (a rule partway through,
+        and where it started) keeps only its most likely way of getting there, and ties go to the
+        split & rule CYK would pick, so binary grammars get the same trees'''
+
+        n = len(tokens)
+        s = self.category_ids.get('S')
+
+        if n == 0 or s == None:
+            return None
+
+        # states[k] maps (rule, dot, start) to [m, e, splits, last child's start], where splits are
+        # the positions between its children so far; done[k] maps (category, start) of everything
+        # spanning start..k - 1 to [m, e, (splits, rule order), rule] (the rule's None for a token);
+        # waiting[k] maps a category to the states at k that need one next
+        states = [{} for _ in range(n + 1)]
+        done = [{} for _ in range(n + 1)]
+        waiting = [defaultdict(list) for _ in range(n + 1)]
+        predicted = [0] * (n + 1) # bitmasks of categories
+
+        def predict(k: int, x: int):
+            new = self.earley_corners[x] & ~predicted[k]
+
+            if not new:
+                return
+
+            predicted[k] |= new
+
+            for y in self.category_bits(new):
+                for r in self.rules_making[y]:
+                    states[k][r, 0, k] = [0.5, 1, (), None] # probability 1
+                    waiting[k][self.earley_rules[r][1][0]].append((r, 0, k))
+
+        def better(m: float, e: int, tie: tuple, old: list) -> bool:
+            # more likely, or just as likely & split earlier (by an earlier rule)
+            return old == None or e > old[1] or (e == old[1] and (m > old[0] or (m == old[0] and tie < old[2])))
+
+        predict(0, s)
+
+        for k in range(1, n + 1):
+            # the token before k, for whichever of its categories were expected
+            finished = []
+
+            for x, p in self.lexical_index.get(tokens[k - 1].sym, ()):
+                if p > 0 and predicted[k - 1] >> x & 1:
+                    done[k][x, k - 1] = [*math.frexp(p), ((), -1), None]
+                    finished.append((x, k - 1))
+
+            # moving every state waiting on something that just finished past it, which can finish
+            # more (e.g. through unary rules), until nothing changes
+            while finished:
+                x, i = finished.pop()
+                m_x, e_x = done[k][x, i][:2]
+
+                for r, dot, start in waiting[i][x]:
+                    m_0, e_0, splits = states[i][r, dot, start][:3]
+                    lhs, rhs, p, order = self.earley_rules[r]
+
+                    m, shift = math.frexp(m_0 * m_x)
+                    e = e_0 + e_x + shift
+                    splits = splits + (i,) if dot > 0 else splits
+
+                    if dot + 1 < len(rhs):
+                        key = (r, dot + 1, start)
+
+                        if better(m, e, splits, states[k].get(key)):
+                            if key not in states[k]:
+                                waiting[k][rhs[dot + 1]].append(key)
+                                predict(k, rhs[dot + 1])
+
+                            states[k][key] = [m, e, splits, i]
+                    else:
+                        m, shift = math.frexp(m * p)
+                        e += shift
+                        key = (r, dot + 1, start)
+
+                        old = done[k].get((lhs, start))
+
+                        # a unary rule's child spans the same tokens as it does, so if it could win a tie,
+                        # two categories could end up each other's child; it has to be strictly more likely
+                        if old == None or (better(m, e, (splits, order), old) if len(rhs) > 1 else (e, m) > (old[1], old[0])):
+                            states[k][key] = [m, e, splits, i]
+                            done[k][lhs, start] = [m, e, (splits, order), r]
+                            finished.append((lhs, start))
+
+        if (s, 0) not in done[n]:
+            return None
+
+        def build(x: int, i: int, k: int) -> ParseTreeNode:
+            r = done[k][x, i][3]
+
+            if r == None:
+                return ParseTreeNode(tokens[i], self.categories[x])
+
+            # back along the rule's states to its first child
+            rhs = self.earley_rules[r][1]
+            children = []
+            end = k
+
+            for dot in range(len(rhs), 0, -1):
+                start = states[end][r, dot, i][3]
+                children.append(build(rhs[dot - 1], start, end))
+                end = start
+
+            return ParseTreeNode.branch(self.categories[x], children[::-1])
+
+        return build(s, 0, n)
+
+    def _build_tree(self, chart: [[dict]], tokens: [Token], x: int, i: int, k: int) -> ParseTreeNode:
+        '''Materialize the best tree for category x over tokens i..k by following the chart's backpointers'''
+
+        entry = chart[i][k][x]
+
+        if entry.split == None:
+            return ParseTreeNode(tokens[i], self.categories[x])
+
+        j = entry.split
+        left = self._build_tree(chart, tokens, entry.left, i, j)
+        right = self._build_tree(chart, tokens, entry.right, j + 1, k)
+
+        return ParseTreeNode(None, self.categories[x], left, right)
+
+    def _parse_numpy(self, tokens: [Token]) -> ParseTreeNode:
+        '''CYK over a dense chart, scoring every rule at every split of a span length in one batch;
+        like the python backend, only the spans & categories that can be part of a parse of the
+        whole sentence are scored, and only at the splits they can have
+
+        It only pays off on long sentences (a few hundred tokens or more, e.g. long chains of requests
+        that aren't split into clauses); below that, numpy's overhead per call outweighs the batching.'''
+
+        n = len(tokens)
+        c = len(self.categories)
+
+        if n == 0 or 'S' not in self.category_ids:
+            return None
+
+        split_lengths = {}
+        needed = self._reachable(tokens, split_lengths)
+
+        if needed == None:
+            return None
+
+        # chart cells are indexed by [span length - 1, start, category], so all the left children
+        # of a span length are one contiguous slice, and all the right children one strided view;
+        # like the python backend's, probabilities are kept as mantissa & exponent so they can't underflow
+        mantissas = np.zeros((n, n, c))
+        exponents = np.full((n, n, c), Grammar.no_exponent, dtype=np.int64)
+        splits = np.zeros((n, n, c), dtype=np.intp) # backpointers: length of the left child...
+        rules = np.zeros((n, n, c), dtype=np.intp)  # ...and the rule that won with it
+
+        for i, tok in enumerate(tokens):
+            for x, p in self.lexical_index.get(tok.sym, ()):
+                if p > 0 and needed[i][i] >> x & 1:
+                    mantissas[0, i, x], exponents[0, i, x] = math.frexp(p)
+
+        def children(chart: 'ndarray', l: int, m: int) -> ('ndarray', 'ndarray'):
+            # left[a - 1, i] is the span of length a at i, right[a - 1, i] the span of length l - a at i + a
+            s0, s1, s2 = chart.strides
+            right = np.lib.stride_tricks.as_strided(chart[l - 2, 1:], shape=(l - 1, m, c), strides=(s1 - s0, s1, s2), writeable=False)
+
+            return chart[:l - 1, :m], right
+
+        pruning = self.beam != None or self.threshold != None
+
+        if pruning and n > 1:
+            self._prune_arrays(mantissas[0], exponents[0])
+
+        for l in range(2, n + 1):
+            m = n + 1 - l # number of spans of this length
+
+            # the spans of this length that are needed at all, and which categories each one needs
+            live = [i for i in range(m) if needed[i][i + l - 1]]
+
+            if not live:
+                continue
+
+            need = np.array([[needed[i][i + l - 1] >> x & 1 for x in range(c)] for i in live], dtype=bool)
+            starts = np.arange(len(live))
+
+            # and the splits any of them can have (everywhere else, nothing's on one side or the other)
+            lengths = split_lengths[l]
+            used = np.array([a - 1 for a in range(1, l) if lengths >> a & 1], dtype=np.intp)
+
+            left_m, right_m = children(mantissas, l, m)
+            left_e, right_e = children(exponents, l, m)
+            left_m, right_m, left_e, right_e = (child[used][:, live] for child in (left_m, right_m, left_e, right_e))
+
+            # max-product score of every rule at every split: (splits, starts, rules)
+            scores_m, shifts = np.frexp(left_m[:, :, self.rule_rhs1] * right_m[:, :, self.rule_rhs2] * self.rule_p)
+            scores_e = left_e[:, :, self.rule_rhs1] + right_e[:, :, self.rule_rhs2] + shifts
+
+            for x, a, b in self.rule_groups:
+                if not need[:, x].any():
+                    continue
+
+                # first best rule per split, then first best split, which is the same winner the python backend keeps
+                group_m = scores_m[:, :, a:b]
+                group_e = scores_e[:, :, a:b]
+                best_rules = Grammar.argmax_scaled(group_m, group_e, 2)
+                best_m = np.take_along_axis(group_m, best_rules[:, :, None], axis=2)[:, :, 0]
+                best_e = np.take_along_axis(group_e, best_rules[:, :, None], axis=2)[:, :, 0]
+                best_splits = Grammar.argmax_scaled(best_m, best_e, 0)
+
+                cell_m = np.where(need[:, x], best_m[best_splits, starts], 0)
+                mantissas[l - 1, live, x] = cell_m
+                exponents[l - 1, live, x] = np.where(cell_m > 0, best_e[best_splits, starts], Grammar.no_exponent)
+                splits[l - 1, live, x] = used[best_splits] + 1
+                rules[l - 1, live, x] = a + best_rules[best_splits, starts]
+
+            if pruning and l < n:
+                self._prune_arrays(mantissas[l - 1, :m], exponents[l - 1, :m])
+
+        s = self.category_ids['S']
+
+        if mantissas[n - 1, 0, s] == 0:
+            return None
+
+        def build(x: int, i: int, l: int) -> ParseTreeNode:
+            if l == 1:
+                return ParseTreeNode(tokens[i], self.categories[x])
+
+            a = splits[l - 1, i, x]
+            r = rules[l - 1, i, x]
+
+            return ParseTreeNode(None, self.categories[x], build(self.rule_rhs1[r], i, a), build(self.rule_rhs2[r], i + a, l - a))
+
+        return build(s, 0, n)
+
+    def _prune_arrays(self, m: 'ndarray', e: 'ndarray'):
+        # _prune for every cell of one span length at once, given their (start, category) mantissas & exponents
+        present = m > 0
+        scores = np.where(present, np.log2(np.where(present, m, 1)) + e, -np.inf)
+        dropped = ~present
+
+        if self.beam != None and self.beam < scores.shape[1]:
+            ranked = np.argsort(-scores, axis=1, kind='stable')
+            np.put_along_axis(dropped, ranked[:, self.beam:], True, axis=1)
+
+        if self.threshold != None:
+            dropped |= scores < scores.max(axis=1, keepdims=True) + self.log_threshold
+
+        m[dropped] = 0
+        e[dropped] = Grammar.no_exponent
+
+    def argmax_scaled(m: 'ndarray', e: 'ndarray', axis: int) -> 'ndarray':
+        # first index of the largest m * 2**e along the axis, for normalized mantissas m
+        top = e.max(axis=axis, keepdims=True)
+        return np.where(e == top, m, -1).argmax(axis=axis)
+
+
+clause_grammar = None # each clause pool worker's own copy of the grammar, since symbols differ between processes
+
+
+def start_clause_worker(data: dict, options: dict):
+    global clause_grammar
+    clause_grammar = Grammar.from_dict(data, **options)
+
+
+def parse_clause(tokens: [Token]) -> ParseTreeNode:
+    return clause_grammar._parse(tokens)
+
+
+def parse_sentence(tokens: [Token]) -> ParseTreeNode:
+    return clause_grammar.parse_tokens(tokens)
@@ -0,0 +1,165 @@
+'''Optional timers & counters for each stage of answering a request: tokenizing, parsing, turning the
+tree into a command, and running it (including how long it spent in a subprocess)
+
+Nothing is kept unless a Stats is made the active one. Until then, the pipeline only checks whether
+one is active before doing any timing or counting of its own, and the parser's inner loops don't
+even do that. With one active, every request's numbers are added up, e.g. for Alfred's :stats. A
+Stats can also write each request's numbers to a trace file as a line of JSON, and can profile each
+request with cProfile.
+
+Clauses parsed on worker processes (see Grammar's workers) aren't counted, since the workers don't
+have the Stats.'''
+
+import cProfile
+import contextvars
+import json
+import os
+import threading
+import time
+
+
+# the Stats being kept, or None to keep none
+active = None
+
+# the numbers of the request being answered; commands run on other threads get a copy of the
+# context they were started from (see run_concurrently), so theirs count towards the same request
+current = contextvars.ContextVar('current', default=None)
+
+
+class Stats:
+    def __init__(self, trace: 'text file' = None, profile_dir: str = None):
+        self.trace = trace # gets a line of JSON per request
+        self.profile_dir = profile_dir # gets a cProfile dump per request
+
+        self.requests = 0
+        self.calls = {} # stage : times it ran
+        self.seconds = {} # stage : total time it took
+        self.counts = {} # counter : total
+
+        self.lock = threading.Lock() # e.g. the daemon answers several clients at once
+
+    def add_time(self, stage: str, seconds: float):
+        request = current.get()
+
+        with self.lock:
+            if request != None:
+                request['ms'][stage] = request['ms'].get(stage, 0) + seconds * 1e3
+
+            self.calls[stage] = self.calls.get(stage, 0) + 1
+            self.seconds[stage] = self.seconds.get(stage, 0) + seconds
+
+    def count(self, counter: str, n: int = 1):
+        request = current.get()
+
+        with self.lock:
+            if request != None:
+                request['counts'][counter] = request['counts'].get(counter, 0) + n
+
+            self.counts[counter] = self.counts.get(counter, 0) + n
+
+    def report(self) -> str:
+        '''The totals so far, as a table'''
+
+        with self.lock:
+            lines = [f'{self.requests} requests', '', f'{"stage":<12} {"calls":>7} {"total ms":>10} {"mean ms":>9}']
+
+            for stage, calls in self.calls.items():
+                total = self.seconds[stage] * 1e3
+                lines.append(f'{stage:<12} {calls:>7} {total:>10.2f} {total / calls:>9.3f}')
+
+            if self.counts:
+                lines += ['', f'{"counter":<24} {"total":>9}']
+                lines += [f'{counter:<24} {n:>9}' for counter, n in sorted(self.counts.items())]
+
+        return '\n'.join(lines)
+
+
+def timed(stage: str, work: 'function', *args):
+    '''work(*args), timed as the given stage if stats are being kept'''
+
+    stats = active
+
+    if stats == None:
+        return work(*args)
+
+    start = time.monotonic()
+
+    try:
+        return work(*args)
+    finally:
+        stats.add_time(stage, time.monotonic() - start)
+
+
+def measured(stage: str, work: 'function', *args) -> (object, dict):
+    '''timed(stage, work, *args) for a request that isn't being answered yet (e.g. parsed ahead of it,
+    on another thread): returns its result along with the numbers it ran up, or None if no stats are
+    being kept, for the request to take in once it is (see Request.take)'''
+
+    if active == None:
+        return work(*args), None
+
+    numbers = {'ms': {}, 'counts': {}}
+    token = current.set(numbers)
+
+    try:
+        return timed(stage, work, *args), numbers
+    finally:
+        current.reset(token)
+
+
+def add_up(numbers: dict, more: dict):
+    # adds one request's (or stage's) numbers to another's
+    for kind in ('ms', 'counts'):
+        for key, n in more[kind].items():
+            numbers[kind][key] = numbers[kind].get(key, 0) + n
+
+
+class Request:
+    '''Context that a sentence is answered inside of, so its numbers are kept together'''
+
+    def __init__(self, sentence: str):
+        self.stats = active
+        self.numbers = {'sentence': sentence, 'ms': {}, 'counts': {}}
+
+    def __enter__(self):
+        if self.stats == None:
+            return self
+
+        self.token = current.set(self.numbers)
+        self.profiler = cProfile.Profile() if self.stats.profile_dir != None else None
+
+        with self.stats.lock:
+            self.stats.requests += 1
+            self.number = self.stats.requests
+
+        self.start = time.monotonic()
+
+        if self.profiler != None:
+            self.profiler.enable()
+
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.stats == None:
+            return
+
+        if self.profiler != None:
+            self.profiler.disable()
+            self.profiler.dump_stats(os.path.join(self.stats.profile_dir, f'request-{self.number}.prof'))
+
+        self.numbers['ms']['total'] = (time.monotonic() - self.start) * 1e3
+        current.reset(self.token)
+
+        if self.stats.trace != None:
+            with self.stats.lock:
+                self.stats.trace.write(json.dumps(self.numbers) + '\n')
+                self.stats.trace.flush()
+
+    def take(self, numbers: dict):
+        '''Counts numbers from measured towards this request (they're already in the totals)'''
+
+        if self.stats == None or numbers == None:
+            return
+
+        with self.stats.lock:
+            add_up(self.numbers, numbers)
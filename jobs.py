@@ -0,0 +1,122 @@
+'''Requests Alfred runs in the background ("... in the background"), so the prompt stays free while
+they do
+
+Each job runs on a thread of its own, on shells of its own: everything it does goes through them
+(even what would otherwise run natively), so cancelling it can kill whatever it's in the middle of,
+along with anything that started. Jobs don't time out, since they're meant for long work.'''
+
+from commands import Command, CommandGroup, job_shells
+from shellpool import ShellPool
+
+import contextvars
+import io
+import re
+import threading
+import time
+
+
+# "..., in the background" at the end of a request
+BACKGROUND = re.compile(r'[ ,]+in the background[.?]*\s*$', re.IGNORECASE)
+
+
+def background_request(sentence: str) -> str:
+    '''The request a sentence asks to be run in the background, or None if it doesn't'''
+
+    match = BACKGROUND.search(sentence)
+    return sentence[:match.start()] if match != None else None
+
+
+class Job:
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+
+    def __init__(self, number: int, sentence: str, cmd: Command):
+        self.number = number
+        self.sentence = sentence
+        self.cmd = cmd
+
+        self.state = Job.RUNNING
+        self.output = io.StringIO()
+        self.shells = ShellPool(CommandGroup.max_workers) # enough for a group's commands to run at once
+        self.started = time.monotonic()
+        self.ended = None
+
+        context = contextvars.copy_context()
+        self.thread = threading.Thread(target=context.run, args=(self.run,), daemon=True)
+        self.thread.start()
+
+    def run(self):
+        job_shells.set(self.shells)
+        crashed = False
+
+        try:
+            self.cmd.stream(self.output)
+        except Exception as e: # there's nothing to raise it to on this thread
+            self.output.write(f'{e}\n')
+            crashed = True
+
+        self.ended = time.monotonic()
+
+        if self.state == Job.RUNNING:
+            self.state = Job.FAILED if crashed or self.cmd.failed() else Job.DONE
+
+        self.shells.close()
+
+    def cancel(self) -> bool:
+        '''Stops the job, if it's still running'''
+
+        if self.state != Job.RUNNING:
+            return False
+
+        self.state = Job.CANCELLED
+        self.shells.close()
+
+        return True
+
+    def is_running(self) -> bool:
+        return self.thread.is_alive()
+
+    def status(self) -> str:
+        seconds = (self.ended if self.ended != None else time.monotonic()) - self.started
+        return f'[{self.number}] {self.state:<9} {seconds:>7.1f}s  {self.sentence}'
+
+
+class Jobs:
+    '''A session's background jobs, numbered in the order they started'''
+
+    def __init__(self):
+        self.jobs = [] # not yet reported as finished
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def start(self, sentence: str, cmd: Command) -> Job:
+        with self.lock:
+            self.count += 1
+            job = Job(self.count, sentence, cmd)
+            self.jobs.append(job)
+
+        return job
+
+    def find(self, number: int) -> Job:
+        with self.lock:
+            return next((job for job in self.jobs if job.number == number), None)
+
+    def running(self) -> [Job]:
+        # a cancelled job's thread can take a moment to wind down, but the job's no longer running
+        with self.lock:
+            return [job for job in self.jobs if job.state == Job.RUNNING]
+
+    def finished(self) -> [Job]:
+        '''The jobs that have finished since this was last asked, which are then forgotten'''
+
+        with self.lock:
+            done = [job for job in self.jobs if not job.is_running()]
+            self.jobs = [job for job in self.jobs if job.is_running()]
+
+        return done
+
+    def cancel_all(self):
+        for job in self.running():
+            job.cancel()
@@ -1,80 +1,98 @@
 from grammar import SyntaxRule, LexicalRule, Grammar
-from tok import WordToken, CommandInputToken, ConjunctorToken
+from tok import WordToken, CommandInputToken, ConjunctorToken, tokenize
 from commands import Command, Context
+from completion import Completer
+from jobs import Jobs, Job, background_request
+from shellpool import ShellPool
+from dircache import ListingCache
+import instrument
 
+import argparse
+import os
 import random
+import sys
+import time
+
+
+QUIT_WORDS = {'\q', 'quit', 'bye', 'goodbye', 'i want out'}
+
+
+def build_grammar(**options) -> Grammar:
+    return Grammar([
+        SyntaxRule('S', 'VP', 'NP', 0.125),
+        SyntaxRule('S', 'VP', 'Noun', 0.125),
+        SyntaxRule('S', 'Verb', 'NP', 0.125),
+        SyntaxRule('S', 'Verb', 'Noun', 0.125),
+        SyntaxRule('S', 'NP', 'VP', 0.125),
+        SyntaxRule('S', 'Noun', 'VP', 0.125),
+        SyntaxRule('S', 'Pronoun', 'VP', 0.125),
+        SyntaxRule('S', 'S', 'ConjClause', 0.125),
+
+        SyntaxRule('ConjClause', 'Conj', 'S', 1),
+
+        SyntaxRule('VP', 'Verb', 'Pronoun', 0.2),
+        SyntaxRule('VP', 'Verb', 'PP', 0.2),
+        SyntaxRule('VP', 'VP', 'PP', 0.2),
+        SyntaxRule('VP', 'Adverb', 'Verb', 0.2),
+        SyntaxRule('VP', 'Adverb', 'VP', 0.2),
+
+        SyntaxRule('NP', 'NP', 'PP', 1/3),
+        SyntaxRule('NP', 'Noun', 'PP', 1/3),
+        SyntaxRule('NP', 'Article', 'Noun', 1/3),
+
+        SyntaxRule('PP', 'Preposition', 'NP', 1/3),
+        SyntaxRule('PP', 'Preposition', 'Noun', 1/3),
+        SyntaxRule('PP', 'Preposition', 'Pronoun', 1/3),
+    ], [
+        LexicalRule('Preposition', 'to', 0.2),
+        LexicalRule('Preposition', 'inside', 0.2),
+        LexicalRule('Preposition', 'in', 0.2),
+        LexicalRule('Preposition', 'from', 0.2),
+        LexicalRule('Preposition', 'of', 0.2),
+
+        LexicalRule('Article', 'the', 1),
+
+        LexicalRule('Noun', 'contents', 0.25),
+        LexicalRule('Noun', 'everything', 0.25),
+        LexicalRule('Noun', CommandInputToken.placeholder(), 0.25),
+        LexicalRule('Noun', 'there', 0.25),
+
+        LexicalRule('Pronoun', 'me', 0.5),
+        LexicalRule('Pronoun', 'what', 0.5),
+
+        LexicalRule('Adverb', 'recursively', 1),
+
+        LexicalRule('Verb', 'run', 1/17),
+        LexicalRule('Verb', 'execute', 1/17),
+        LexicalRule('Verb', 'do', 1/17),
+        LexicalRule('Verb', 'show', 1/17),
+        LexicalRule('Verb', 'list', 1/17),
+        LexicalRule('Verb', 'tell', 1/17),
+        LexicalRule('Verb', 'move', 1/17),
+        LexicalRule('Verb', 'rename', 1/17),
+        LexicalRule('Verb', 'place', 1/17),
+        LexicalRule('Verb', 'copy', 1/17),
+        LexicalRule('Verb', 'duplicate', 1/17),
+        LexicalRule('Verb', 'delete', 1/17),
+        LexicalRule('Verb', 'remove', 1/17),
+        LexicalRule('Verb', 'is', 1/17),
+        LexicalRule('Verb', 'put', 1/17),
+        LexicalRule('Verb', 'display', 1/17),
+        LexicalRule('Verb', 'find', 1/17),
+
+        LexicalRule('Conj', 'and', 1/3),
+        LexicalRule('Conj', 'then', 1/3),
+        LexicalRule('Conj', ConjunctorToken(), 1/3),
+    ], **options)
 
 
 class Alfred:
-    def __init__(self):
+    def __init__(self, parse_workers: int = None):
         self.context = Context()
 
-        self.grammar = Grammar([
-            SyntaxRule('S', 'VP', 'NP', 0.125),
-            SyntaxRule('S', 'VP', 'Noun', 0.125),
-            SyntaxRule('S', 'Verb', 'NP', 0.125),
-            SyntaxRule('S', 'Verb', 'Noun', 0.125),
-            SyntaxRule('S', 'NP', 'VP', 0.125),
-            SyntaxRule('S', 'Noun', 'VP', 0.125),
-            SyntaxRule('S', 'Pronoun', 'VP', 0.125),
-            SyntaxRule('S', 'S', 'ConjClause', 0.125),
-
-            SyntaxRule('ConjClause', 'Conj', 'S', 1),
-
-            SyntaxRule('VP', 'Verb', 'Pronoun', 0.2),
-            SyntaxRule('VP', 'Verb', 'PP', 0.2),
-            SyntaxRule('VP', 'VP', 'PP', 0.2),
-            SyntaxRule('VP', 'Adverb', 'Verb', 0.2),
-            SyntaxRule('VP', 'Adverb', 'VP', 0.2),
-
-            SyntaxRule('NP', 'NP', 'PP', 1/3),
-            SyntaxRule('NP', 'Noun', 'PP', 1/3),
-            SyntaxRule('NP', 'Article', 'Noun', 1/3),
-
-            SyntaxRule('PP', 'Preposition', 'NP', 1/3),
-            SyntaxRule('PP', 'Preposition', 'Noun', 1/3),
-            SyntaxRule('PP', 'Preposition', 'Pronoun', 1/3),
-        ], [
-            LexicalRule('Preposition', 'to', 0.2),
-            LexicalRule('Preposition', 'inside', 0.2),
-            LexicalRule('Preposition', 'in', 0.2),
-            LexicalRule('Preposition', 'from', 0.2),
-            LexicalRule('Preposition', 'of', 0.2),
-
-            LexicalRule('Article', 'the', 1),
-
-            LexicalRule('Noun', 'contents', 0.25),
-            LexicalRule('Noun', 'everything', 0.25),
-            LexicalRule('Noun', CommandInputToken.placeholder(), 0.25),
-            LexicalRule('Noun', 'there', 0.25),
-
-            LexicalRule('Pronoun', 'me', 0.5),
-            LexicalRule('Pronoun', 'what', 0.5),
-
-            LexicalRule('Adverb', 'recursively', 1),
-
-            LexicalRule('Verb', 'run', 1/17),
-            LexicalRule('Verb', 'execute', 1/17),
-            LexicalRule('Verb', 'do', 1/17),
-            LexicalRule('Verb', 'show', 1/17),
-            LexicalRule('Verb', 'list', 1/17),
-            LexicalRule('Verb', 'tell', 1/17),
-            LexicalRule('Verb', 'move', 1/17),
-            LexicalRule('Verb', 'rename', 1/17),
-            LexicalRule('Verb', 'place', 1/17),
-            LexicalRule('Verb', 'copy', 1/17),
-            LexicalRule('Verb', 'duplicate', 1/17),
-            LexicalRule('Verb', 'delete', 1/17),
-            LexicalRule('Verb', 'remove', 1/17),
-            LexicalRule('Verb', 'is', 1/17),
-            LexicalRule('Verb', 'put', 1/17),
-            LexicalRule('Verb', 'display', 1/17),
-            LexicalRule('Verb', 'find', 1/17),
-
-            LexicalRule('Conj', 'and', 1/3),
-            LexicalRule('Conj', 'then', 1/3),
-            LexicalRule('Conj', ConjunctorToken(), 1/3),
-        ])
+        self.grammar = build_grammar(cache_size=256, split_clauses=True, workers=parse_workers)
+
+        self.jobs = Jobs()
 
 
     def bad_grammar_error(self) -> str:
@@ -99,30 +117,245 @@ class Alfred:
         return f'I understood {noun}, but ' + random.choice(responses)
 
 
-    def serve(self):
+    def interpret(self, sentence: str, context: Context) -> 'Command or str':
+        # the command a sentence asks for, or the error response if there isn't one
+        tokens = instrument.timed('tokenize', tokenize, sentence.lower())
+        tree = instrument.timed('parse', self.grammar.parse_tokens, tokens)
+
+        return self.command(tree, context)
+
+
+    def command(self, tree: 'ParseTreeNode', context: Context) -> 'Command or str':
+        # the command a parse tree stands for, or the error response if there isn't one
+        if tree != None:
+            cmd = instrument.timed('interpret', Command.from_parse_tree, tree, context)
+
+            if cmd != None:
+                return cmd
+            else:
+                return self.invalid_command_error()
+        else:
+            return self.bad_grammar_error()
+
+
+    def respond(self, sentence: str, context: Context = None) -> str:
+        '''Alfred's response to a sentence, remembering paths in the given context (his own by default)'''
+
+        with instrument.Request(sentence):
+            cmd = self.interpret(sentence, context if context != None else self.context)
+
+            return instrument.timed('exec', cmd.exec) if type(cmd) != str else cmd
+
+
+    def stream_response(self, sentence: str, out: 'text file', context: Context = None):
+        '''Writes Alfred's response to a sentence to out, passing along any command output as it's produced'''
+
+        with instrument.Request(sentence):
+            cmd = self.interpret(sentence, context if context != None else self.context)
+
+            if type(cmd) != str:
+                instrument.timed('exec', cmd.stream, out)
+            else:
+                out.write(cmd + '\n')
+                out.flush()
+
+
+    def run_batch(self, sentences: 'iterable of strs', out: 'text file', ahead: int = 64) -> str:
+        '''Answers each sentence in turn, streaming the responses to out, while the sentences after it
+        are tokenized & parsed ahead of time; returns a summary of how it went'''
+
+        start = time.monotonic()
+        answered = not_understood = not_commands = failed = 0
+
+        for sentence, tokens, tree, numbers in self.grammar.parse_ahead(sentences, ahead):
+            with instrument.Request(sentence) as request:
+                request.take(numbers)
+
+                # commands are only made from their trees in order, just before they run, so "there"
+                # is always the last path of the sentences before
+                cmd = self.command(tree, self.context)
+
+                out.write(f'> {sentence}\n')
+
+                if type(cmd) != str:
+                    instrument.timed('exec', cmd.stream, out)
+                    failed += cmd.failed()
+                else:
+                    out.write(cmd + '\n')
+
+                    if tree == None:
+                        not_understood += 1
+                    else:
+                        not_commands += 1
+
+                out.write('\n')
+                out.flush()
+
+            answered += 1
+
+        seconds = time.monotonic() - start
+        rate = answered / seconds if seconds > 0 else 0
+
+        return f'{answered} requests in {seconds:.2f}s ({rate:.1f}/s): {failed} failed, {not_understood} not understood, {not_commands} not commands'
+
+
+    def start_job(self, sentence: str) -> str:
+        '''Starts running what a sentence asks for in the background, returning Alfred's response'''
+
+        # interpreted right away, so "there" means the same as it would if the job ran in the foreground
+        cmd = self.interpret(sentence, self.context)
+
+        if type(cmd) == str:
+            return cmd
+
+        job = self.jobs.start(sentence, cmd)
+
+        return f"I'll {random.choice(['do', 'run'])} that in the background as job [{job.number}]"
+
+
+    def report_job(self, job: Job) -> str:
+        # what a finished job did, once it's done
+        if job.state == Job.CANCELLED:
+            return f'[{job.number}] Cancelled: {job.sentence}'
+
+        heading = 'Finished' if job.state == Job.DONE else 'Failed'
+        return f'[{job.number}] {heading}: {job.sentence}\n' + job.output.getvalue().rstrip('\n')
+
+
+    def cancel(self, args: [str]) -> str:
+        running = self.jobs.running()
+
+        if not args:
+            if not running:
+                return "There's nothing running in the background"
+
+            job = running[-1] # the latest
+        elif args[0].isdigit():
+            job = self.jobs.find(int(args[0]))
+
+            if job == None:
+                return f"There's no job [{args[0]}] running"
+        else:
+            return 'Which job? Tell me its number, e.g. "cancel 1"'
+
+        if not job.cancel():
+            return f'Job [{job.number}] has already stopped ({job.state})'
+
+        return f'Alright, I cancelled job [{job.number}]'
+
+
+    def meta_command(self, sentence: str) -> str:
+        '''The response to a command about Alfred himself (e.g. ":jobs"), or None if the sentence isn't one'''
+
+        words = sentence.strip().lstrip(':').split()
+
+        if not words:
+            return None
+        elif words[0] == 'stats' and len(words) == 1:
+            return self.stats()
+        elif words[0] == 'jobs' and len(words) == 1:
+            running = self.jobs.running()
+            return '\n'.join(job.status() for job in running) if running else "There's nothing running in the background"
+        elif words[0] == 'cancel' and len(words) <= 2:
+            return self.cancel(words[1:])
+
+        return None
+
+
+    def stats(self) -> str:
+        '''Where the time's gone answering requests so far, if it's being kept track of'''
+
+        if instrument.active == None:
+            return "I'm not keeping stats; start me with --stats to see them"
+
+        report = instrument.active.report()
+
+        if self.grammar.cache != None:
+            report += '\n\nparse cache: ' + ', '.join(f'{name} {n}' for name, n in self.grammar.cache.stats().items())
+
+        if Command.listings != None:
+            report += '\nlisting cache: ' + ', '.join(f'{name} {n}' for name, n in Command.listings.stats().items())
+
+        return report
+
+
+    def serve(self, stream: bool = False):
+        Completer(self.grammar).install()
+
         while True:
+            for job in self.jobs.finished():
+                print(self.report_job(job) + '\n')
+
             sentence = input('    How can I help you?  ')
             print()
 
-            if sentence.lower() in {'\q', 'quit', 'bye', 'goodbye', 'i want out'}:
+            if sentence.lower() in QUIT_WORDS:
                 print('Bye!')
                 break
 
-            tree = self.grammar.parse(sentence)
+            response = self.meta_command(sentence)
 
-            if tree != None:
-                cmd = Command.from_parse_tree(tree, self.context)
+            if response != None:
+                print(response + '\n')
+                continue
 
-                if cmd != None:
-                    print(cmd.exec())
+            try:
+                if background_request(sentence) != None:
+                    print(self.start_job(background_request(sentence)))
+                elif stream:
+                    self.stream_response(sentence, sys.stdout)
                 else:
-                    print(self.invalid_command_error())
-            else:
-                print(self.bad_grammar_error())
+                    print(self.respond(sentence))
+            except KeyboardInterrupt:
+                # shells run in sessions of their own, so ^C doesn't reach what they're running
+                Command.interrupt()
+
+                print('\nAlright, I stopped.')
 
+        self.jobs.cancel_all()
         print()
 
 
 if __name__ == '__main__':
-    alfred = Alfred()
-    alfred.serve()
+    parser = argparse.ArgumentParser(description='A natural language terminal interface')
+    parser.add_argument('--shell', action='store_true', help='run ls, mv, cp & rm through the shell instead of natively')
+    parser.add_argument('--fork-shells', action='store_true', help='start a new shell for every shell command instead of reusing a pool of them')
+    parser.add_argument('--stream', action='store_true', help='show command output as it\'s produced instead of once the command is done')
+    parser.add_argument('--parse-workers', type=int, help='parse the clauses of long requests on this many worker processes')
+    parser.add_argument('--spool-size', type=int, default=Command.spool_size, help='characters of held-back output to keep in memory when streaming before spilling to disk')
+
+    parser.add_argument('--listing-cache', type=int, default=Command.listings.size, help='directory listings to keep cached for listing again (0 to keep none)')
+    parser.add_argument('--timeout', type=float, help='stop commands that run for longer than this many seconds (except in the background); they all go through the shell so they can be')
+    parser.add_argument('--batch', help='answer each line of this file (or stdin, for -) in turn, skipping blank lines & lines starting with #, then exit')
+    parser.add_argument('--stats', action='store_true', help='keep track of the time spent in each stage of answering requests, shown by typing :stats')
+    parser.add_argument('--trace', help='append each request\'s stats to this file as a line of JSON (implies --stats)')
+    parser.add_argument('--profile', help='profile each request with cProfile, saving the results in this directory (implies --stats)')
+
+    args = parser.parse_args()
+    Command.use_shell = args.shell
+    Command.spool_size = args.spool_size
+
+    if args.fork_shells:
+        Command.shell_pool = None
+    elif args.timeout != None:
+        Command.shell_pool = ShellPool(timeout=args.timeout)
+
+    Command.timeout = args.timeout
+    Command.listings = ListingCache(args.listing_cache) if args.listing_cache > 0 else None
+
+    if args.stats or args.trace or args.profile:
+        if args.profile:
+            os.makedirs(args.profile, exist_ok=True)
+
+        instrument.active = instrument.Stats(open(args.trace, 'a') if args.trace else None, args.profile)
+
+    if args.batch:
+        lines = sys.stdin if args.batch == '-' else open(args.batch)
+        sentences = (line.strip() for line in lines if line.strip() and not line.lstrip().startswith('#'))
+
+        alfred = Alfred(args.parse_workers)
+        print(alfred.run_batch(sentences, sys.stdout))
+        alfred.grammar.close()
+    else:
+        alfred = Alfred(args.parse_workers)
+        alfred.serve(args.stream)
@@ -0,0 +1,144 @@
+'''Runs a group's commands concurrently wherever they can't interfere with each other
+
+Each command declares the paths it reads & writes (see Command.paths). A command has to wait for
+every earlier command whose paths overlap its own where at least one of the two writes; commands
+that don't declare their paths (e.g. raw shell commands) wait for, and are waited on by, everything.
+
+When a group's output is streamed, each command writes to an OutputRelay, which holds its output back
+until every command before it is done, so it all still comes out in order.'''
+
+import contextvars
+import os
+import tempfile
+import threading
+
+
+def normalize(path: str) -> str:
+    return os.path.normpath(os.path.abspath(path))
+
+
+def overlaps(a: str, b: str) -> bool:
+    # paths stand for themselves & everything under them
+    return a == b or a.startswith(b.rstrip(os.sep) + os.sep) or b.startswith(a.rstrip(os.sep) + os.sep)
+
+
+def conflicts(a: (set, set), b: (set, set)) -> bool:
+    if a == None or b == None:
+        return True
+
+    reads_a, writes_a = a
+    reads_b, writes_b = b
+
+    return any(overlaps(x, y) for x in writes_a for y in reads_b | writes_b) or \
+        any(overlaps(x, y) for x in writes_b for y in reads_a)
+
+
+def dependencies(cmds: ['Command']) -> [[int]]:
+    '''For each command, the earlier commands it has to wait for'''
+
+    from commands import local # not at the top, since commands imports this module
+
+    accesses = []
+
+    for cmd in cmds:
+        paths = cmd.paths()
+
+        if paths != None:
+            # relative to whoever asked for the commands, e.g. a daemon client (this runs in their context)
+            reads, writes = paths
+            paths = {normalize(local(path)) for path in reads}, {normalize(local(path)) for path in writes}
+
+        accesses.append(paths)
+
+    return [[j for j in range(i) if conflicts(accesses[i], accesses[j])] for i in range(len(cmds))]
+
+
+def run_concurrently(cmds: ['Command'], max_workers: int, work: 'function' = None, on_turn: 'function' = None) -> [str]:
+    '''Executes the commands, each as soon as its dependencies are done, returning their responses in order
+
+    work(i) is what's done for the i-th command (its exec() by default), and on_turn(i) is called once
+    everything before the i-th command is done'''
+
+    # not at the top, since importing concurrent.futures takes longer than the rest of Alfred's startup,
+    # and most requests are a single command that never gets here
+    from concurrent.futures import ThreadPoolExecutor, CancelledError
+
+    if work == None:
+        work = lambda i: cmds[i].exec()
+
+    deps = dependencies(cmds)
+
+    pool = ThreadPoolExecutor(max_workers=max_workers)
+    futures = []
+    stopped = threading.Event()
+
+    def run(i: int) -> str:
+        # dependencies were submitted first, so they're already running (or done) by now
+        for j in deps[i]:
+            futures[j].result()
+
+        if stopped.is_set():
+            raise CancelledError()
+
+        return work(i)
+
+    try:
+        for i in range(len(cmds)):
+            # in the caller's context, e.g. so instrument counts the command towards its request
+            futures.append(pool.submit(contextvars.copy_context().run, run, i))
+
+        results = []
+
+        for i, future in enumerate(futures):
+            if on_turn != None:
+                on_turn(i)
+
+            results.append(future.result())
+    except BaseException:
+        # e.g. ^C; whatever hasn't started never does, and whatever has is left to whoever
+        # interrupted it to stop (see Command.interrupt)
+        stopped.set()
+
+        for future in futures:
+            future.cancel()
+
+        pool.shutdown(wait=False)
+        raise
+
+    pool.shutdown()
+    return results
+
+
+class OutputRelay:
+    '''A stand-in for an output file that holds everything written to it (in memory up to max_size
+    characters, then in a temporary file) until it goes live, then passes it all through'''
+
+    def __init__(self, max_size: int):
+        self.spool = tempfile.SpooledTemporaryFile(max_size=max_size, mode='w+')
+        self.out = None
+        self.lock = threading.Lock()
+
+    def write(self, text: str):
+        with self.lock:
+            if self.out != None:
+                self.out.write(text)
+            else:
+                self.spool.write(text)
+
+    def flush(self):
+        with self.lock:
+            if self.out != None:
+                self.out.flush()
+
+    def go_live(self, out: 'text file'):
+        with self.lock:
+            self.spool.seek(0)
+
+            for chunk in iter(lambda: self.spool.read(65536), ''):
+                out.write(chunk)
+
+            out.flush()
+            self.out = out
+
+    def close(self):
+        self.spool.close()
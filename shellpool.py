@@ -0,0 +1,320 @@
+'''A pool of long-lived shells to run shell commands on, instead of starting a new /bin/sh for each one
+
+Each command is sent to an idle shell wrapped in a subshell (so things like `cd` or `exit` can't
+affect the shell itself) that starts from the caller's current directory, followed by a unique
+sentinel on both stdout & stderr; everything before the sentinels is the command's output, and the
+exit code comes after the stdout one.'''
+
+from queue import Queue, Empty
+
+import codecs
+import os
+import re
+import selectors
+import shlex
+import signal
+import subprocess
+import threading
+import time
+import uuid
+
+
+class ShellDied(Exception):
+    pass
+
+
+class Shell:
+    def __init__(self):
+        self.proc = subprocess.Popen(['/bin/sh'], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True)
+
+    def is_alive(self) -> bool:
+        return self.proc.poll() == None
+
+    def stop(self):
+        # kills the shell and anything it's still running, leaving its pipes for whoever's reading them
+        try:
+            os.killpg(self.proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    def kill(self):
+        self.stop()
+        self.proc.wait()
+
+        for pipe in (self.proc.stdin, self.proc.stdout, self.proc.stderr):
+            pipe.close()
+
+    def run(self, command: str, timeout: float = None, on_output: 'function' = None, cwd: str = None) -> subprocess.CompletedProcess:
+        sentinel = f'__alfred_{uuid.uuid4().hex}'.encode()
+
+        # the shell stays wherever it started, so the command runs from cwd (our current directory by
+        # default); eval keeps a command with unbalanced quotes or parens from swallowing the rest of the script
+        script = f'''( cd -- {shlex.quote(cwd if cwd != None else os.getcwd())} && eval {shlex.quote(command)} ) < /dev/null
+printf '\\n%s %d\\n' {sentinel.decode()} $?
+printf '\\n%s\\n' {sentinel.decode()} >&2
+'''
+
+        try:
+            self.proc.stdin.write(script.encode())
+            self.proc.stdin.flush()
+        except BrokenPipeError:
+            raise ShellDied()
+
+        stdout_end = re.compile(b'\n' + sentinel + b' (-?[0-9]+)\n')
+        stderr_end = b'\n' + sentinel + b'\n'
+
+        # when streaming, the end of stdout is held back if it could be the start of the sentinel line
+        marker = b'\n' + sentinel + b' '
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+        buffers = {self.proc.stdout.fileno(): bytearray(), self.proc.stderr.fileno(): bytearray()}
+        stdout = stderr = returncode = None
+        deadline = time.monotonic() + timeout if timeout != None else None
+
+        with selectors.DefaultSelector() as selector:
+            for fd in buffers:
+                selector.register(fd, selectors.EVENT_READ)
+
+            while stdout == None or stderr == None:
+                remaining = deadline - time.monotonic() if deadline != None else None
+
+                if remaining != None and remaining <= 0:
+                    raise TimeoutError(f'{command!r} timed out after {timeout}s')
+
+                for key, _ in selector.select(remaining):
+                    chunk = os.read(key.fd, 65536)
+
+                    if not chunk:
+                        raise ShellDied()
+
+                    buffer = buffers[key.fd]
+                    buffer += chunk
+
+                    if key.fd == self.proc.stdout.fileno():
+                        # only where the sentinel line could end in what was just read, so reading
+                        # a lot of output doesn't search it all over again for each chunk
+                        end = stdout_end.search(buffer, max(0, len(buffer) - len(chunk) - len(marker) - 12))
+
+                        if end != None:
+                            stdout = bytes(buffer[:end.start()])
+                            returncode = int(end.group(1))
+                            selector.unregister(key.fd)
+
+                        if on_output != None:
+                            ready = len(stdout) if stdout != None else Shell.safe_length(buffer, marker)
+
+                            if ready > 0:
+                                text = decoder.decode(bytes(buffer[:ready]), final=stdout != None)
+                                del buffer[:ready]
+
+                                if text:
+                                    on_output(text)
+
+                            if stdout != None:
+                                stdout = b'' # it's all been passed along
+                    else:
+                        end = buffer.find(stderr_end, max(0, len(buffer) - len(chunk) - len(stderr_end)))
+
+                        if end != -1:
+                            stderr = bytes(buffer[:end])
+                            selector.unregister(key.fd)
+
+        return subprocess.CompletedProcess(command, returncode, stdout.decode(errors='replace'), stderr.decode(errors='replace'))
+
+
+    def safe_length(buffer: bytearray, marker: bytes) -> int:
+        # how much of the buffer can't be part of a (partly read) sentinel line starting with marker
+        start = max(0, len(buffer) - len(marker) - 12) # room for the marker & an exit code
+
+        while True:
+            i = buffer.find(b'\n', start)
+
+            if i == -1:
+                return len(buffer)
+
+            tail = bytes(buffer[i:])
+
+            if marker.startswith(tail) or tail.startswith(marker):
+                return i
+
+            start = i + 1
+
+
+class ShellPool:
+    def __init__(self, size: int = 4, timeout: float = None):
+        self.size = size
+        self.timeout = timeout # how long a command may run before its shell is considered hung
+
+        self.idle = Queue()
+        self.started = 0
+        self.busy = set() # shells running a command right now
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def acquire(self) -> Shell:
+        # shells are only started when they're needed
+        with self.lock:
+            if self.idle.empty() and self.started < self.size:
+                self.started += 1
+                shell = Shell()
+                self.busy.add(shell)
+                return shell
+
+        shell = self.idle.get()
+
+        with self.lock:
+            self.busy.add(shell)
+
+        return shell
+
+    def release(self, shell: Shell):
+        with self.lock:
+            self.busy.discard(shell)
+
+        if shell.is_alive() and not self.closed:
+            self.idle.put(shell)
+        else:
+            self.replace(shell)
+
+    def replace(self, shell: Shell):
+        with self.lock:
+            self.busy.discard(shell)
+
+        shell.kill()
+
+        # once the pool's closed, whoever's waiting for a shell gets a dead one, which fails right away
+        self.idle.put(Shell() if not self.closed else shell)
+
+    def run(self, command: str, on_output: 'function' = None, cwd: str = None) -> subprocess.CompletedProcess:
+        '''Runs the command like subprocess.run(command, shell=True, capture_output=True, text=True, cwd=cwd) would,
+        or if on_output is given, passes stdout to it as it's produced instead of capturing it'''
+
+        if self.closed:
+            return subprocess.CompletedProcess(command, -1, '', 'the shells for this command were closed')
+
+        shell = self.acquire()
+
+        if self.closed: # while waiting for a shell
+            self.replace(shell)
+            return subprocess.CompletedProcess(command, -1, '', 'the shells for this command were closed')
+
+        try:
+            result = shell.run(command, self.timeout, on_output, cwd)
+        except ShellDied:
+            # the shell died before or while running the command; it can't be told which, so it isn't retried
+            self.replace(shell)
+            return subprocess.CompletedProcess(command, -1, '', 'the shell running this command died')
+        except TimeoutError as e:
+            self.replace(shell)
+            return subprocess.CompletedProcess(command, -1, '', str(e))
+        except BaseException:
+            self.replace(shell) # e.g. ^C partway through reading its output
+            raise
+
+        self.release(shell)
+        return result
+
+    def interrupt(self):
+        '''Kills whatever the pool's shells are running right now; each of those commands fails, and its
+        shell is replaced'''
+
+        with self.lock:
+            busy = list(self.busy)
+
+        for shell in busy:
+            shell.stop()
+
+    def close(self):
+        '''Kills the pool's shells, including any running a command, after which nothing more runs on it'''
+
+        self.closed = True
+        self.interrupt()
+
+        while True:
+            try:
+                self.idle.get_nowait().kill()
+            except Empty:
+                break
+
+
+# shells run_fresh has running
+fresh_shells = set()
+fresh_lock = threading.Lock()
+
+
+def run_fresh(command: str, on_output: 'function' = None, timeout: float = None, cwd: str = None) -> subprocess.CompletedProcess:
+    '''Runs the command on a new shell of its own, passing stdout to on_output as it's produced if given;
+    if it takes longer than timeout seconds, or is interrupted, the shell and everything it started are killed'''
+
+    with subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True, cwd=cwd) as proc:
+        # the shell leads its own process group, so the group can be killed along with it
+        def kill():
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+        with fresh_lock:
+            fresh_shells.add(proc)
+
+        try:
+            if on_output == None:
+                stdout, stderr = proc.communicate(timeout=timeout)
+                return subprocess.CompletedProcess(command, proc.returncode, stdout.decode(errors='replace'), stderr.decode(errors='replace'))
+
+            # stderr is drained on the side, so a command can't block writing to it while stdout is read
+            stderr = []
+            reader = threading.Thread(target=lambda: stderr.append(proc.stderr.read()))
+            reader.start()
+
+            timer = threading.Timer(timeout, kill) if timeout != None else None
+
+            if timer != None:
+                timer.start()
+
+            decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+            for chunk in iter(lambda: proc.stdout.read1(65536), b''):
+                text = decoder.decode(chunk)
+
+                if text:
+                    on_output(text)
+
+            text = decoder.decode(b'', final=True)
+
+            if text:
+                on_output(text)
+
+            reader.join()
+            proc.wait()
+
+            if timer != None:
+                timer.cancel()
+
+                if timer.finished.is_set() and proc.returncode == -signal.SIGKILL:
+                    raise subprocess.TimeoutExpired(command, timeout)
+        except subprocess.TimeoutExpired:
+            kill()
+            proc.communicate()
+            return subprocess.CompletedProcess(command, -1, '', f'{command!r} timed out after {timeout}s')
+        except BaseException:
+            kill() # e.g. ^C
+            raise
+        finally:
+            with fresh_lock:
+                fresh_shells.discard(proc)
+
+    return subprocess.CompletedProcess(command, proc.returncode, '', stderr[0].decode(errors='replace'))
+
+
+def interrupt_fresh():
+    '''Kills whatever run_fresh is running right now, on any thread'''
+
+    with fresh_lock:
+        procs = list(fresh_shells)
+
+    for proc in procs:
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
@@ -4,12 +4,52 @@
     # conjunctor (comma)
     # end of sentence (period, optional & ignored)
 
+import re
+
+class Vocabulary:
+    '''Symbol table interning words to integer ids, so tokens can be matched with integer comparisons'''
+
+    # reserved ids; every command input shares one id, and so does every word the vocabulary doesn't know
+    unknown = 0
+    command_input = 1
+    conjunctor = 2
+
+    def __init__(self):
+        self.words = ['<unknown>', '<command input>', ',']
+        self.ids = {}
+
+    def __len__(self) -> int:
+        return len(self.words)
+
+    def intern(self, word: 'str or Token') -> int:
+        '''Returns the id of a word (or token), adding it to the vocabulary if it's new'''
+
+        if type(word) == WordToken:
+            word = word.word
+        elif isinstance(word, Token):
+            return word.sym
+
+        sym = self.ids.get(word)
+
+        if sym == None:
+            sym = self.ids[word] = len(self.words)
+            self.words.append(word)
+
+        return sym
+
+    def lookup(self, word: str) -> int:
+        return self.ids.get(word, Vocabulary.unknown)
+
+# shared by the tokenizer, the grammar (which interns its lexicon) and the command readers
+vocabulary = Vocabulary()
+
 class Token: # empty base class
     pass
 
 class WordToken(Token):
     def __init__(self, word: str):
         self.word = word
+        self.sym = vocabulary.lookup(word)
 
     def __repr__(self) -> str:
         return f'"{self.word}"'
@@ -27,7 +67,13 @@ class WordToken(Token):
     def __hash__(self):
         return hash(self.word)
 
+    def __reduce__(self):
+        # symbols are only meaningful within one process, so unpickling looks the word up again
+        return WordToken, (self.word,)
+
 class CommandInputToken(Token):
+    sym = Vocabulary.command_input
+
     def __init__(self, content: str):
         self.content = content
 
@@ -36,20 +82,22 @@ class CommandInputToken(Token):
 
     def __eq__(self, tok: 'any') -> bool:
         if type(tok) == CommandInputToken:
-            # "catch-all" cmd input when content is None
-            return self.content == tok.content if self.content != None else True
+            return self.content == tok.content
         elif isinstance(tok, Token):
             return False
         else:
             return NotImplemented
 
     def __hash__(self):
-        return hash('cmd')
+        return hash(self.content)
 
     def placeholder() -> 'CommandInputToken':
+        # stands for any command input in rules & lexicons, since all of them share one symbol
         return CommandInputToken(None)
 
 class ConjunctorToken(Token):
+    sym = Vocabulary.conjunctor
+
     def __repr__(self) -> str:
         return f','
 
@@ -64,54 +112,37 @@ class ConjunctorToken(Token):
     def __hash__(self):
         return hash(',')
 
+# one group per kind of token, in the order (command input, conjunctor, word); anything else
+# (spaces, '.' and '?') matches no group and is skipped. an unterminated command input runs to
+# the end of the sentence
+token_pattern = re.compile(r'(`[^`]*`?)|(,)|([^`,.? ][^ ]*)|[.? ]+')
+
+def make_token(cmd_input: str, conj: str, word: str) -> Token:
+    if word:
+        return WordToken(word)
+    elif cmd_input:
+        # strip the backticks (the closing one may be missing)
+        return CommandInputToken(cmd_input[1:-1] if len(cmd_input) > 1 and cmd_input[-1] == '`' else cmd_input[1:])
+    elif conj:
+        return ConjunctorToken()
+    else:
+        return None
+
+def iter_tokens(sentence: str) -> 'yields tokens':
+    # scans lazily, so large inputs can be consumed as a stream
+    for match in token_pattern.finditer(sentence):
+        token = make_token(*match.groups(''))
+
+        if token != None:
+            yield token
+
 def tokenize(sentence: str) -> 'list of tokens':
     tokens = []
-    i = 0
-    chars = len(sentence)
-
-    while i < chars:
-        c = sentence[i]
-
-        if c == '`':
-            # command input
-            cmd_input = ''
-            i += 1
-            c = sentence[i]
-
-            while i < chars and c != '`':
-                cmd_input += c
-                i += 1
-
-                if i < chars:
-                    c = sentence[i]
-                else:
-                    break
-
-            token = CommandInputToken(cmd_input)
-            tokens.append(token)
-
-            i += 1
-        elif c == ',':
-            # conjunctor
-            tokens.append(ConjunctorToken())
-            i += 1
-        elif c in {'.', ' ', '?'}:
-            # basically ignore appropriate end-of-sentence indicators and spaces
-            i += 1
-        else:
-            # word
-            word = ''
-
-            while c != ' ':
-                word += c
-                i += 1
 
-                if i < chars:
-                    c = sentence[i]
-                else:
-                    break
+    for groups in token_pattern.findall(sentence):
+        token = make_token(*groups)
 
-            token = WordToken(word)
+        if token != None:
             tokens.append(token)
 
     return tokens
@@ -0,0 +1,292 @@
+'''Matches parse trees against declarative patterns, for every kind of command at once
+
+Each owner (a kind of command) describes the trees it accepts with named patterns, starting from
+the one named "command":
+
+    Node(cat, left, right)     a node of category cat whose children match left & right
+    Word(cat)                  a leaf of category cat whose word the lexicon allows for cat
+    Subtree(cat, slot)         any node of category cat, bound whole to slot
+    Either(*patterns)          any of the patterns
+    Ref(name)                  the owner's pattern with that name (so patterns can be recursive)
+    Using(lexicon, pattern)    the pattern, with a new lexicon (categories it leaves out allow no words)
+    Setting(changes, pattern)  the pattern, after changing some categories of the current lexicon
+
+Trees are matched top-down & left to right, and the lexicon is carried along as they are, so an
+owner's effects (words that change the lexicon when they're reached, e.g. "contents" only allowing
+"of" after it) apply to everything after them. Every leaf an owner reaches binds the slot its
+binds give for that word before the word is checked, and an owner stops at its first mismatch,
+keeping whatever it had bound by then; it's up to the owner whether that's enough.
+
+All the owners' patterns make up one automaton, whose states are sets of (owner, pattern, lexicon)
+items, so a single walk over a tree matches it against everything. States & transitions are built
+the first time they're needed and cached, after which each node of a tree costs a few lookups.'''
+
+from tok import vocabulary
+
+import threading
+
+
+def lexicon_symbols(words: {str : tuple}) -> {str : frozenset}:
+    return {cat: frozenset(vocabulary.intern(word) for word in cat_words) for cat, cat_words in words.items()}
+
+
+class Node:
+    def __init__(self, cat: str, left, right):
+        self.cat = cat
+        self.left = left
+        self.right = right
+
+
+class Word:
+    def __init__(self, cat: str):
+        self.cat = cat
+
+
+class Subtree:
+    def __init__(self, cat: str, slot: str):
+        self.cat = cat
+        self.slot = slot
+
+
+class Either:
+    def __init__(self, *patterns):
+        self.patterns = patterns
+
+
+class Ref:
+    def __init__(self, name: str):
+        self.name = name
+
+
+class Using:
+    def __init__(self, lexicon: {str : tuple}, pattern):
+        self.lexicon = lexicon_symbols(lexicon)
+        self.pattern = pattern
+
+
+class Setting:
+    def __init__(self, changes: {str : tuple}, pattern):
+        self.changes = lexicon_symbols(changes)
+        self.pattern = pattern
+
+
+class TreeMatcher:
+    def __init__(self, owners: list):
+        '''Owners are tried in order, and each needs patterns (a dict of named patterns), binds (a dict
+        of (cat, word) : slot) and effects (a dict of (cat, word) : lexicon changes)'''
+
+        self.owners = owners
+
+        self.binds = {
+            owner: {(cat, vocabulary.intern(word)): slot for (cat, word), slot in owner.binds.items()}
+            for owner in owners
+        }
+
+        self.effects = {
+            owner: {(cat, vocabulary.intern(word)): lexicon_symbols(changes) for (cat, word), changes in owner.effects.items()}
+            for owner in owners
+        }
+
+        # lexicons, states & exits (what finished matching a subtree, and with which lexicon) are
+        # all interned, so transitions can be keyed on small ints
+        self.lexicons = []
+        self.lexicon_ids = {}
+        self.states = []
+        self.state_ids = {}
+        self.exits = []
+        self.exit_ids = {}
+
+        self.leaf_steps = {}
+        self.down_steps = {}
+        self.across_steps = {}
+        self.up_steps = {}
+
+        self.lock = threading.Lock()
+
+        self.state(frozenset()) # 0, where nothing's left to match
+        self.exit(frozenset())  # 0, where nothing matched
+
+        empty = self.lexicon({})
+        self.start = self.state({(owner, *item) for owner in owners for item in self.expand(owner, Ref('command'), empty)})
+
+    def match(self, tree: 'ParseTreeNode') -> [('owner', [(str, object)])]:
+        '''Each owner that bound anything, in order, with the (slot, token or node) pairs it bound'''
+
+        bindings = []
+        self.walk(tree, self.start, bindings)
+
+        if not bindings:
+            return []
+
+        found = {}
+
+        for owner, slot, value in bindings:
+            found.setdefault(owner, []).append((slot, value))
+
+        return [(owner, found[owner]) for owner in self.owners if owner in found]
+
+    def walk(self, node: 'ParseTreeNode', state: int, bindings: list) -> int:
+        if state == 0:
+            return 0
+
+        if node.left == None: # a leaf (checking data would go through Token.__eq__)
+            key = (state, node.cat, node.data.sym)
+            step = self.leaf_steps.get(key) or self.step(self.leaf_steps, key, self.leaf)
+
+            for owner, slot in step[1]:
+                bindings.append((owner, slot, node.data))
+
+            return step[0]
+
+        key = (state, node.cat, node.left.cat, node.right.cat)
+        down = self.down_steps.get(key) or self.step(self.down_steps, key, self.down)
+
+        for owner, slot in down[1]:
+            bindings.append((owner, slot, node))
+
+        left = self.walk(node.left, down[0], bindings)
+        across = self.across_steps.get((key, left)) or self.step(self.across_steps, (key, left), self.across)
+        right = self.walk(node.right, across[0], bindings)
+
+        up = self.up_steps.get((key, left, right))
+
+        if up == None:
+            up = self.step(self.up_steps, (key, left, right), self.up)
+
+        return up
+
+    def step(self, steps: dict, key: tuple, build: 'function'):
+        # builds a transition the first time it's taken
+        with self.lock:
+            if key not in steps:
+                steps[key] = build(*key)
+
+            return steps[key]
+
+    def leaf(self, state: int, cat: str, sym: int) -> (int, tuple):
+        done = set()
+        binds = []
+
+        for item in self.states[state]:
+            owner, pattern, lexicon = item
+
+            if type(pattern) != Word or pattern.cat != cat:
+                continue
+
+            slot = self.binds[owner].get((cat, sym))
+
+            if slot != None and (owner, slot) not in binds:
+                binds.append((owner, slot))
+
+            changes = self.effects[owner].get((cat, sym))
+
+            if changes != None:
+                lexicon = self.lexicon({**self.lexicons[lexicon], **changes})
+
+            if sym in self.lexicons[lexicon].get(cat, ()):
+                done.add((item, lexicon))
+
+        return self.exit(done), tuple(binds)
+
+    def down(self, state: int, cat: str, left_cat: str, right_cat: str) -> (int, tuple, list, set):
+        matched = [] # (item, its left child's items)
+        owners = set()
+
+        for item in self.states[state]:
+            owner, pattern, lexicon = item
+
+            if type(pattern) == Node and pattern.cat == cat and right_cat in self.cats(owner, pattern.right):
+                lefts = [(owner, *left) for left in self.expand(owner, pattern.left, lexicon) if left[0].cat == left_cat]
+
+                if lefts:
+                    matched.append((item, lefts))
+                    owners.add(owner)
+
+        # a whole subtree only matches where nothing more specific of its owner's does
+        binds = []
+        done = set()
+
+        for item in self.states[state]:
+            owner, pattern, lexicon = item
+
+            if type(pattern) == Subtree and pattern.cat == cat and owner not in owners:
+                binds.append((owner, pattern.slot))
+                done.add((item, lexicon))
+
+        return self.state({left for _, lefts in matched for left in lefts}), tuple(binds), matched, done
+
+    def across(self, key: tuple, left: int) -> (int, list):
+        right_cat = key[3]
+        finished = self.exits[left]
+        links = [] # (item, one of its right child's items)
+
+        for item, lefts in self.down_steps[key][2]:
+            owner, pattern, _ = item
+
+            for left_item in lefts:
+                for lexicon in finished.get(left_item, ()):
+                    for right in self.expand(owner, pattern.right, lexicon):
+                        if right[0].cat == right_cat:
+                            links.append((item, (owner, *right)))
+
+        return self.state({right for _, right in links}), links
+
+    def up(self, key: tuple, left: int, right: int) -> int:
+        finished = self.exits[right]
+        done = set(self.down_steps[key][3])
+
+        for item, right_item in self.across_steps[key, left][1]:
+            for lexicon in finished.get(right_item, ()):
+                done.add((item, lexicon))
+
+        return self.exit(done)
+
+    def expand(self, owner, pattern, lexicon: int) -> [(object, int)]:
+        # the Nodes, Words & Subtrees a pattern can start with, each with the lexicon it's matched with
+        kind = type(pattern)
+
+        if kind == Either:
+            return [item for alternative in pattern.patterns for item in self.expand(owner, alternative, lexicon)]
+        elif kind == Ref:
+            return self.expand(owner, owner.patterns[pattern.name], lexicon)
+        elif kind == Using:
+            return self.expand(owner, pattern.pattern, self.lexicon(pattern.lexicon))
+        elif kind == Setting:
+            return self.expand(owner, pattern.pattern, self.lexicon({**self.lexicons[lexicon], **pattern.changes}))
+        else:
+            return [(pattern, lexicon)]
+
+    def cats(self, owner, pattern) -> set:
+        return {item.cat for item, _ in self.expand(owner, pattern, 0)}
+
+    def lexicon(self, lexicon: {str : frozenset}) -> int:
+        key = frozenset(lexicon.items())
+
+        if key not in self.lexicon_ids:
+            self.lexicon_ids[key] = len(self.lexicons)
+            self.lexicons.append(lexicon)
+
+        return self.lexicon_ids[key]
+
+    def state(self, items: set) -> int:
+        key = frozenset(items)
+
+        if key not in self.state_ids:
+            self.state_ids[key] = len(self.states)
+            self.states.append(key)
+
+        return self.state_ids[key]
+
+    def exit(self, done: set) -> int:
+        key = frozenset(done)
+
+        if key not in self.exit_ids:
+            finished = {}
+
+            for item, lexicon in key:
+                finished.setdefault(item, set()).add(lexicon)
+
+            self.exit_ids[key] = len(self.exits)
+            self.exits.append(finished)
+
+        return self.exit_ids[key]